@@ -0,0 +1,148 @@
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.ad.ranking import CampaignMatrix, CampaignRecord, Creative
+from src.ad.utils import single_flight
+from src.campaign.models import CampaignModel, LocationModel
+from src.config import SessionLocal
+
+# Записи, тексты объявлений и локации таргетинга (название -> id)
+LoadedRecords = Tuple[Dict[UUID, CampaignRecord], Dict[UUID, Creative], Dict[str, int]]
+
+
+# ========================
+# ACTIVE CAMPAIGN INDEX
+# ========================
+
+class ActiveCampaignIndex:
+    """
+    Индекс активных кампаний воркера для текущего дня.
+
+    Строится один раз на (current_date, campaigns_version): версия в Redis
+    увеличивается при каждом изменении кампаний, поэтому изменения с других
+    воркеров приводят к перестроению, а свои применяются инкрементально.
+    Хранит компактные CampaignRecord, тексты объявлений — отдельно,
+    и словарь локаций таргетинга для перевода локации клиента в id.
+    Используется только из event loop воркера: между await состояние меняется целиком.
+    """
+
+    def __init__(self):
+        self._date: Optional[int] = None
+        self._version: Optional[int] = None
+        self._campaigns: Dict[UUID, CampaignRecord] = {}
+        self._creatives: Dict[UUID, Creative] = {}
+        # id локаций не меняются, поэтому словарь только пополняется
+        self._locations: Dict[str, int] = {}
+        self._snapshot: Optional[CampaignMatrix] = None
+
+    async def get(self, current_date: int, version: int) -> CampaignMatrix:
+        if self._date == current_date and self._version == version:
+            return self._get_snapshot()
+        # Параллельные промахи воркера ждут одно перестроение
+        return await single_flight(f"active_campaigns:{current_date}:{version}",
+                                   lambda: self._rebuild(current_date, version))
+
+    async def refresh_campaign(self, campaign_id: UUID, version: int) -> None:
+        if self._version is None or self._version + 1 != version:
+            return  # индекс отстал, перестроится при следующем get
+
+        async with SessionLocal() as session:
+            row = (await session.execute(
+                select(*CAMPAIGN_RECORD_COLUMNS).where(CampaignModel.campaign_id == campaign_id)
+            )).one_or_none()
+
+        if self._version is None or self._version + 1 != version:
+            return
+        if row is not None and row.start_date <= self._date <= row.end_date:
+            self._campaigns[campaign_id], self._creatives[campaign_id] = CampaignRecord.from_row(row)
+            if row.target_location is not None:
+                self._locations[row.target_location] = row.target_location_id
+        else:
+            self._campaigns.pop(campaign_id, None)
+            self._creatives.pop(campaign_id, None)
+        self._version = version
+        self._snapshot = None
+
+    async def _rebuild(self, current_date: int, version: int) -> CampaignMatrix:
+        previous_date = self._date if self._version == version else None
+
+        async with SessionLocal() as session:
+            if previous_date is not None and previous_date < current_date:
+                # Время только движется вперёд: догружаем начавшиеся кампании
+                campaigns, creatives, locations = await self._advance(session, previous_date, current_date)
+            else:
+                campaigns, creatives, locations = await load_active_campaigns(session, current_date)
+
+        self._date, self._version = current_date, version
+        self._campaigns, self._creatives = campaigns, creatives
+        self._locations.update(locations)
+        self._snapshot = None
+        return self._get_snapshot()
+
+    def clear(self) -> None:
+        self._date, self._version = None, None
+        self._campaigns, self._creatives, self._locations = {}, {}, {}
+        self._snapshot = None
+
+    async def _advance(self, session: AsyncSession, previous_date: int, current_date: int) -> LoadedRecords:
+        campaigns = {
+            campaign_id: campaign for campaign_id, campaign in self._campaigns.items()
+            if campaign.end_date >= current_date
+        }
+        creatives = {campaign_id: self._creatives[campaign_id] for campaign_id in campaigns}
+        started, started_creatives, locations = await _load_records(session, (
+            CampaignModel.start_date > previous_date,
+            CampaignModel.start_date <= current_date,
+            CampaignModel.end_date >= current_date,
+        ))
+        campaigns.update(started)
+        creatives.update(started_creatives)
+        return campaigns, creatives, locations
+
+    def _get_snapshot(self) -> CampaignMatrix:
+        if self._snapshot is None:
+            self._snapshot = CampaignMatrix(self._campaigns.values(), dict(self._creatives), dict(self._locations))
+        return self._snapshot
+
+
+# Только колонки, нужные рекламному пути: без ORM-объектов и identity map
+CAMPAIGN_RECORD_COLUMNS = (
+    CampaignModel.campaign_id,
+    CampaignModel.advertiser_id,
+    CampaignModel.cost_per_impression,
+    CampaignModel.cost_per_click,
+    CampaignModel.impressions_limit,
+    CampaignModel.start_date,
+    CampaignModel.end_date,
+    CampaignModel.target_gender,
+    CampaignModel.target_min_age,
+    CampaignModel.target_max_age,
+    CampaignModel.target_location_id,
+    # Подзапросом, а не join: порядок строк (и разрешение равенств при ранжировании) не меняется
+    select(LocationModel.name)
+    .where(LocationModel.location_id == CampaignModel.target_location_id)
+    .scalar_subquery().label("target_location"),
+    CampaignModel.ad_title,
+    CampaignModel.ad_text,
+)
+
+async def load_active_campaigns(session: AsyncSession, current_date: int) -> LoadedRecords:
+    return await _load_records(session, (
+        CampaignModel.start_date <= current_date,
+        CampaignModel.end_date >= current_date,
+    ))
+
+
+async def _load_records(session: AsyncSession, criteria) -> LoadedRecords:
+    campaigns, creatives, locations = {}, {}, {}
+    for row in await session.execute(select(*CAMPAIGN_RECORD_COLUMNS).where(*criteria)):
+        campaigns[row.campaign_id], creatives[row.campaign_id] = CampaignRecord.from_row(row)
+        if row.target_location is not None:
+            locations[row.target_location] = row.target_location_id
+    return campaigns, creatives, locations
+
+
+active_campaigns = ActiveCampaignIndex()
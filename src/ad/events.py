@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Sequence, Tuple, Union
+
+import redis.asyncio as redis
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.ad.models import AdViewModel, ProcessedEventModel
+from src.ad.ranking import CampaignRecord
+from src.ad.utils import AD_VIEWS_KEY, EVENTS_STREAM_KEY, IMPRESSIONS_TOTAL_KEY, load_views, single_flight
+from src.ad.services import Action
+from src.campaign.models import CampaignModel
+from src.config import SessionLocal, settings
+from src.stats.cache import publish_stats_changes
+from src.stats.services import increment_daily_stats
+
+logger = logging.getLogger(__name__)
+
+# Поток показов и кликов (EVENTS_STREAM_KEY): пишут роутеры, читает консьюмер в группе
+EVENTS_GROUP = "stats_flusher"
+
+# Атомарно: отметка в ad_views дня, событие в поток и +1 к счётчику показов, если он прогрет.
+# Лимит показов здесь не проверяется — его учитывает ранжирование по счётчику, прочитанному до выбора,
+# поэтому параллельные запросы могут превысить лимит на число одновременных показов.
+# ARGV: client_id, campaign_id, затем поля события парами. 1 — показ записан,
+# 0 — клиент уже видел рекламу сегодня, nil — множество дня ещё не прогрето
+RECORD_VIEW_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+if redis.call('SADD', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('XADD', KEYS[3], '*', unpack(ARGV, 3))
+if redis.call('HEXISTS', KEYS[2], ARGV[2]) == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+end
+return 1
+"""
+
+
+# ========================
+# PUBLISHING
+# ========================
+
+def view_event(campaign: CampaignRecord, client_id: uuid.UUID, day: int) -> Dict[str, str]:
+    return _event(Action.VIEW, campaign, client_id, day, campaign.cost_per_impression)
+
+
+def click_event(campaign: CampaignModel, client_id: uuid.UUID, day: int) -> Dict[str, str]:
+    return _event(Action.CLICK, campaign, client_id, day, campaign.cost_per_click)
+
+
+def _event(action: str, campaign: Union[CampaignRecord, CampaignModel], client_id: uuid.UUID, day: int,
+           cost: float) -> Dict[str, str]:
+    # event_id делает повторную обработку того же события идемпотентной
+    return {
+        "event_id": str(uuid.uuid4()),
+        "action": action,
+        "campaign_id": str(campaign.campaign_id),
+        "client_id": str(client_id),
+        "day": str(day),
+        "cost": repr(float(cost)),
+    }
+
+
+async def publish_events(r: redis.Redis, events: Sequence[Dict[str, str]]) -> None:
+    async with r.pipeline(transaction=False) as pipe:
+        for ad_event in events:
+            pipe.xadd(EVENTS_STREAM_KEY, ad_event)
+        await pipe.execute()
+
+
+async def record_view(r: redis.Redis, day: int, campaign: CampaignRecord, client_id: uuid.UUID) -> bool:
+    # True, если это первый показ клиенту за день и событие ушло в поток
+    key = AD_VIEWS_KEY.format(day=day)
+    ad_event = view_event(campaign, client_id, day)
+    script = r.register_script(RECORD_VIEW_SCRIPT)
+    keys = [key, IMPRESSIONS_TOTAL_KEY, EVENTS_STREAM_KEY]
+    args = [str(client_id), str(campaign.campaign_id), *(item for field in ad_event.items() for item in field)]
+
+    recorded = await script(keys=keys, args=args)
+    if recorded is None:
+        await single_flight(key, lambda: load_views(r, day))
+        recorded = await script(keys=keys, args=args)
+    return bool(recorded)
+
+
+# ========================
+# CONSUMER
+# ========================
+
+async def ensure_group(r: redis.Redis) -> None:
+    try:
+        await r.xgroup_create(EVENTS_STREAM_KEY, EVENTS_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def consume_events(r: redis.Redis, consumer: str, block_ms: int = None) -> int:
+    # Сначала свои неподтверждённые события, затем зависшие у упавших консьюмеров, затем новые
+    entries = await _read_group(r, consumer, "0")
+    if not entries:
+        _, entries, *_ = await r.xautoclaim(EVENTS_STREAM_KEY, EVENTS_GROUP, consumer,
+                                            settings.EVENTS_CLAIM_IDLE_MS, count=settings.EVENTS_BATCH_SIZE)
+        entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+    if not entries:
+        entries = await _read_group(r, consumer, ">", block_ms)
+    if not entries:
+        return 0
+
+    await flush_events(entries, r)
+
+    # Подтверждаем только после коммита: при падении события будут прочитаны повторно
+    entry_ids = [entry_id for entry_id, _ in entries]
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.xack(EVENTS_STREAM_KEY, EVENTS_GROUP, *entry_ids)
+        pipe.xdel(EVENTS_STREAM_KEY, *entry_ids)
+        await pipe.execute()
+    return len(entries)
+
+
+async def run_event_consumer() -> None:
+    r = redis.Redis.from_url(settings.REDIS_URL)
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        await ensure_group(r)
+        while True:
+            try:
+                await consume_events(r, consumer, settings.EVENTS_BLOCK_MS)
+            except redis.ResponseError as e:
+                if "NOGROUP" not in str(e):
+                    raise
+                await ensure_group(r)
+            except Exception:
+                logger.exception("Failed to flush ad events")
+                await asyncio.sleep(1)
+    finally:
+        await r.aclose()
+
+
+async def _read_group(r: redis.Redis, consumer: str, stream_id: str, block_ms: int = None) -> List[Tuple]:
+    response = await r.xreadgroup(EVENTS_GROUP, consumer, {EVENTS_STREAM_KEY: stream_id},
+                                  count=settings.EVENTS_BATCH_SIZE, block=block_ms)
+    return [(entry_id, fields) for entry_id, fields in response[0][1] if fields] if response else []
+
+
+# ========================
+# FLUSHING
+# ========================
+
+async def flush_events(entries: Sequence[Tuple], r: redis.Redis = None) -> None:
+    events = list({ad_event["event_id"]: ad_event for ad_event in map(_parse_event, entries)}.values())
+
+    async with SessionLocal() as session:
+        try:
+            await _apply_events(session, events)
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+
+            # Событие удалённой кампании не должно блокировать весь поток
+            for ad_event in events:
+                try:
+                    await _apply_events(session, [ad_event])
+                    await session.commit()
+                except IntegrityError:
+                    await session.rollback()
+                    logger.warning("Dropping ad event %s", ad_event["event_id"])
+
+        if r is not None:
+            await publish_stats_changes(r, session)
+
+
+async def _apply_events(session: AsyncSession, events: Sequence[dict]) -> None:
+    if not events:
+        return
+
+    processed = set(await session.scalars(
+        insert(ProcessedEventModel)
+        .values([{"event_id": ad_event["event_id"]} for ad_event in events])
+        .on_conflict_do_nothing()
+        .returning(ProcessedEventModel.event_id)
+    ))
+    events = [ad_event for ad_event in events if ad_event["event_id"] in processed]
+
+    stats: Dict[Tuple[uuid.UUID, int], dict] = {}
+    views = []
+    for ad_event in events:
+        stat = stats.setdefault((ad_event["campaign_id"], ad_event["day"]), {
+            "campaign_id": ad_event["campaign_id"],
+            "day": ad_event["day"],
+            "impressions_count": 0,
+            "clicks_count": 0,
+            "spent_impressions": 0.0,
+            "spent_clicks": 0.0,
+        })
+        if ad_event["action"] == Action.VIEW:
+            stat["impressions_count"] += 1
+            stat["spent_impressions"] += ad_event["cost"]
+            views.append({
+                "campaign_id": ad_event["campaign_id"],
+                "client_id": ad_event["client_id"],
+                "view_date": ad_event["day"],
+            })
+        else:
+            stat["clicks_count"] += 1
+            stat["spent_clicks"] += ad_event["cost"]
+
+    if views:
+        await session.execute(insert(AdViewModel), views)
+    await increment_daily_stats(session, list(stats.values()))
+
+    if events:
+        await session.execute(delete(ProcessedEventModel).where(
+            ProcessedEventModel.created_at < func.now() - timedelta(seconds=settings.EVENTS_LEDGER_TTL)))
+
+
+def _parse_event(entry: Tuple) -> dict:
+    _, fields = entry
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return {
+        "event_id": uuid.UUID(fields["event_id"]),
+        "action": fields["action"],
+        "campaign_id": uuid.UUID(fields["campaign_id"]),
+        "client_id": uuid.UUID(fields["client_id"]),
+        "day": int(fields["day"]),
+        "cost": float(fields["cost"]),
+    }
@@ -1,5 +1,5 @@
 from src.config import Base
-from sqlalchemy import Column, UUID, Integer, Boolean, ForeignKey
+from sqlalchemy import Column, UUID, Integer, Boolean, ForeignKey, Index, DateTime, func
 import uuid
 
 class AdViewModel(Base):
@@ -9,3 +9,15 @@ class AdViewModel(Base):
     campaign_id = Column(UUID(as_uuid=True), ForeignKey("campaign.campaign_id"), nullable=False)
     client_id = Column(UUID(as_uuid=True), ForeignKey("client.client_id"), nullable=False)
     view_date = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_ad_view_view_date_client_id", "view_date", "client_id"),
+    )
+
+
+class ProcessedEventModel(Base):
+    __tablename__ = "processed_event"
+
+    event_id = Column(UUID(as_uuid=True), primary_key=True)
+    # Время записи в Postgres: по нему чистится журнал, условный день для этого не годится
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
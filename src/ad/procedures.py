@@ -0,0 +1,112 @@
+from typing import Optional, Tuple
+
+from sqlalchemy import DDL, event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.ad.ranking import DEFAULT_WEIGHTS, CampaignRecord, Creative
+from src.ad.targeting import gender_code
+from src.config import Base
+
+# ========================
+# RANKING IN POSTGRES
+# ========================
+
+# Тот же расчёт, что calculate_campaign_metrics + normalize_metrics, одним запросом.
+# Вся арифметика в float8 и в том же порядке операций, что и в Python, поэтому результаты
+# совпадают побитово. Кампании возвращаются по убыванию composite_score; при равенстве —
+# по campaign_id, как в CampaignMatrix.rank.
+RANK_CAMPAIGNS_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION rank_campaigns(
+    p_day integer, p_client_id uuid, p_gender smallint, p_age integer, p_location varchar
+) RETURNS SETOF campaign
+LANGUAGE sql STABLE AS $$
+WITH active AS (
+    SELECT
+        c AS campaign,
+        c.impressions_limit AS impressions_limit,
+        v.total_views,
+        COALESCE((SELECT m.score FROM ml_score m
+                  WHERE m.client_id = p_client_id AND m.advertiser_id = c.advertiser_id LIMIT 1), 0)::float8
+            / 100 AS ml_score,
+        (c.target_gender IS NOT NULL AND c.target_gender <> p_gender)
+            OR NOT (c.target_min_age <= p_age AND p_age <= c.target_max_age)
+            OR (c.target_location_id IS NOT NULL AND c.target_location_id IS DISTINCT FROM
+                (SELECT l.location_id FROM location l WHERE l.name = p_location)) AS violated
+    FROM campaign c
+    CROSS JOIN LATERAL (
+        SELECT COALESCE(sum(d.impressions_count), 0)::float8 AS total_views
+        FROM daily_stat d WHERE d.campaign_id = c.campaign_id
+    ) v
+    WHERE c.start_date <= p_day AND c.end_date >= p_day
+),
+excess AS (
+    SELECT
+        a.*,
+        floor(greatest(0, a.total_views - a.impressions_limit) / nullif(a.impressions_limit, 0) * 100 / 5)
+            AS steps,
+        greatest(0, a.total_views - a.impressions_limit) / nullif(a.impressions_limit, 0) * 100
+            AS excess_percentage
+    FROM active a
+),
+penalized AS (
+    SELECT
+        e.*,
+        -- floor(x / 5) может округлиться до следующего целого; // в Python в этом случае на единицу меньше
+        CASE WHEN e.impressions_limit > 0
+            THEN (e.steps - CASE WHEN e.steps * 5 > e.excess_percentage THEN 1 ELSE 0 END) * 0.05::float8
+            ELSE 0::float8 END
+        + CASE WHEN e.violated THEN 0.10::float8 ELSE 0::float8 END AS penalties
+    FROM excess e
+),
+metrics AS (
+    SELECT
+        p.campaign,
+        ((p.campaign).cost_per_impression + p.ml_score * (p.campaign).cost_per_click)
+            * (1 - least(p.penalties, 1.0::float8)) AS expected_profit,
+        p.ml_score * 100 AS relevance,
+        least(CASE WHEN p.impressions_limit > 0 THEN p.total_views / p.impressions_limit
+                   ELSE 1.0::float8 END, 2.0::float8) AS fulfillment
+    FROM penalized p
+    WHERE p.penalties < 1.0
+),
+bounds AS (
+    SELECT
+        m.*,
+        min(m.expected_profit) OVER () AS profit_min,
+        max(m.expected_profit) OVER () AS profit_max,
+        min(m.fulfillment) OVER () AS fulfillment_min,
+        max(m.fulfillment) OVER () AS fulfillment_max
+    FROM metrics m
+)
+SELECT (b.campaign).*
+FROM bounds b
+ORDER BY
+    {DEFAULT_WEIGHTS['profit']!r}::float8 * CASE WHEN b.profit_max - b.profit_min > 0
+        THEN (b.expected_profit - b.profit_min) / (b.profit_max - b.profit_min) ELSE 0.5::float8 END
+    + {DEFAULT_WEIGHTS['relevance']!r}::float8 * (b.relevance / 100)
+    + {DEFAULT_WEIGHTS['fulfillment']!r}::float8 * CASE WHEN b.fulfillment_max - b.fulfillment_min > 0
+        THEN (b.fulfillment - b.fulfillment_min) / (b.fulfillment_max - b.fulfillment_min) ELSE 0.5::float8 END
+    DESC,
+    (b.campaign).campaign_id
+$$
+"""
+
+# Функция создаётся после всех таблиц и удаляется до них: она зависит от типа строки campaign
+event.listen(Base.metadata, "after_create", DDL(RANK_CAMPAIGNS_FUNCTION))
+event.listen(Base.metadata, "before_drop", DDL("DROP FUNCTION IF EXISTS rank_campaigns"))
+
+
+async def select_best_campaign_sql(db: AsyncSession, client, today: int
+                                   ) -> Optional[Tuple[CampaignRecord, Creative]]:
+    # Решение одним запросом без снапшота кампаний воркера
+    row = (await db.execute(
+        text("SELECT * FROM rank_campaigns(:day, :client_id, :gender, :age, :location) LIMIT 1"),
+        {
+            "day": today,
+            "client_id": client.client_id,
+            "gender": gender_code(client.gender),
+            "age": client.age,
+            "location": client.location,
+        }
+    )).one_or_none()
+    return CampaignRecord.from_row(row) if row is not None else None
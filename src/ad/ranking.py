@@ -0,0 +1,175 @@
+import numpy as np
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+from uuid import UUID
+
+from src.ad.targeting import CompiledTargeting, TargetingIndex, gender_code
+
+DEFAULT_WEIGHTS = {'profit': 0.5, 'relevance': 0.25, 'fulfillment': 0.15}
+
+
+# ========================
+# COMPACT CAMPAIGN RECORDS
+# ========================
+
+class CampaignRecord(NamedTuple):
+    """Неизменяемая запись кампании для рекламного пути: без ORM-состояния и текстов объявления."""
+    campaign_id: UUID
+    advertiser_id: UUID
+    cost_per_impression: float
+    cost_per_click: float
+    impressions_limit: int
+    start_date: int
+    end_date: int
+    targeting: CompiledTargeting
+
+    @classmethod
+    def from_row(cls, row) -> Tuple['CampaignRecord', 'Creative']:
+        # row — строка select по CAMPAIGN_RECORD_COLUMNS или CampaignModel
+        record = cls(
+            row.campaign_id, row.advertiser_id, float(row.cost_per_impression), float(row.cost_per_click),
+            row.impressions_limit, row.start_date, row.end_date,
+            (row.target_gender, row.target_min_age, row.target_max_age, row.target_location_id),
+        )
+        return record, Creative(row.ad_title, row.ad_text)
+
+
+class Creative(NamedTuple):
+    ad_title: str
+    ad_text: str
+
+
+# ========================
+# COLUMNAR CAMPAIGN SNAPSHOT
+# ========================
+
+class CampaignMatrix:
+    """
+    Колоночное представление активных кампаний для векторного ранжирования.
+
+    Повторяет calculate_campaign_metrics и normalize_metrics из services.py,
+    но считает все кампании за один проход. Массивы по последней оси
+    соответствуют кампаниям, поэтому rank принимает и матрицы (клиенты x кампании).
+    """
+
+    def __init__(self, campaigns: Sequence[CampaignRecord], creatives: Optional[Dict[UUID, Creative]] = None,
+                 locations: Optional[Dict[str, int]] = None):
+        # Порядок по campaign_id разрешает равенство composite_score так же, как rank_campaigns в Postgres,
+        # независимо от порядка загрузки и обновления снапшота
+        self.campaigns = tuple(sorted(campaigns, key=lambda campaign: campaign.campaign_id))
+        self.creatives = creatives or {}
+        # Локация клиента -> id; локации без таргетинга в снапшоте не нужны
+        self.locations = locations or {}
+        self.positions: Dict[UUID, int] = {campaign.campaign_id: i for i, campaign in enumerate(self.campaigns)}
+        count = len(self.campaigns)
+
+        self.cost_per_impression = np.fromiter(
+            (campaign.cost_per_impression for campaign in self.campaigns), dtype=np.float64, count=count)
+        self.cost_per_click = np.fromiter(
+            (campaign.cost_per_click for campaign in self.campaigns), dtype=np.float64, count=count)
+        self.impressions_limit = np.fromiter(
+            (campaign.impressions_limit for campaign in self.campaigns), dtype=np.float64, count=count)
+        self._no_limit = self.impressions_limit <= 0
+        self._limit_or_one = np.where(self._no_limit, 1.0, self.impressions_limit)
+
+        self.advertiser_index: Dict[UUID, int] = {}
+        for campaign in self.campaigns:
+            self.advertiser_index.setdefault(campaign.advertiser_id, len(self.advertiser_index))
+        self.advertiser_codes = np.fromiter(
+            (self.advertiser_index[campaign.advertiser_id] for campaign in self.campaigns), dtype=np.intp, count=count)
+
+        self.targeting = TargetingIndex([campaign.targeting for campaign in self.campaigns])
+
+    def __len__(self):
+        return len(self.campaigns)
+
+    def get(self, campaign_id: Optional[UUID]) -> Optional[CampaignRecord]:
+        position = self.positions.get(campaign_id)
+        return self.campaigns[position] if position is not None else None
+
+    def is_violated(self, client) -> np.ndarray:
+        return self.targeting.is_violated(
+            gender_code(client.gender), client.age, self.locations.get(client.location))
+
+    def ml_scores(self, ml_score_map: Dict[UUID, float]) -> np.ndarray:
+        advertiser_scores = np.zeros(len(self.advertiser_index), dtype=np.float64)
+        for advertiser_id, score in ml_score_map.items():
+            code = self.advertiser_index.get(advertiser_id)
+            if code is not None:
+                advertiser_scores[code] = score
+        return advertiser_scores[self.advertiser_codes]
+
+    def composite_scores(
+            self,
+            ml_scores: np.ndarray,
+            total_views: np.ndarray,
+            is_violated: np.ndarray,
+            weights: Dict[str, float] = DEFAULT_WEIGHTS
+    ) -> np.ndarray:
+        # Кампании со штрафом 100% и выше получают -inf.
+        # Операции те же, что в calculate_campaign_metrics, но на месте, чтобы не плодить временные массивы
+        with np.errstate(divide='ignore', invalid='ignore'):
+            penalties = np.subtract(total_views, self.impressions_limit)
+            np.maximum(penalties, 0, out=penalties)
+            penalties /= self._limit_or_one
+            penalties *= 100
+            np.floor_divide(penalties, 5, out=penalties)
+            penalties *= 0.05
+            np.copyto(penalties, 0.0, where=self._no_limit)
+            np.add(penalties, 0.10, out=penalties, where=is_violated)
+            valid = penalties < 1.0
+
+            expected_profit = np.multiply(ml_scores, self.cost_per_click)
+            expected_profit += self.cost_per_impression
+            np.minimum(penalties, 1.0, out=penalties)
+            np.subtract(1, penalties, out=penalties)
+            expected_profit *= penalties
+
+            fulfillment = np.divide(total_views, self._limit_or_one)
+            np.copyto(fulfillment, 1.0, where=self._no_limit)
+            np.minimum(fulfillment, 2.0, out=fulfillment)
+
+            relevance = np.multiply(ml_scores, 100)
+            relevance /= 100
+
+            composite_score = _normalize(expected_profit, valid)
+            composite_score *= weights['profit']
+            relevance *= weights['relevance']
+            composite_score += relevance
+            fulfillment = _normalize(fulfillment, valid)
+            fulfillment *= weights['fulfillment']
+            composite_score += fulfillment
+
+        np.copyto(composite_score, -np.inf, where=~valid)
+        return composite_score
+
+    def rank(
+            self,
+            ml_scores: np.ndarray,
+            total_views: np.ndarray,
+            is_violated: np.ndarray,
+            weights: Dict[str, float] = DEFAULT_WEIGHTS,
+            top_k: int = 1
+    ) -> np.ndarray:
+        # Индексы лучших кампаний по убыванию composite_score, при равенстве — по campaign_id
+        if not self.campaigns:
+            return np.empty(0, dtype=np.intp)
+
+        scores = self.composite_scores(ml_scores, total_views, is_violated, weights)
+        if top_k == 1:
+            best = np.argmax(scores)
+            return np.array([best] if scores[best] > -np.inf else [], dtype=np.intp)
+
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return order[scores[order] > -np.inf]
+
+
+def _normalize(values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    # min-max по допустимым кампаниям, 0.5 при нулевом разбросе
+    low = np.where(valid, values, np.inf).min(axis=-1, keepdims=True)
+    high = np.where(valid, values, -np.inf).max(axis=-1, keepdims=True)
+    spread = high - low
+    return np.divide(
+        values - low, spread,
+        out=np.full(values.shape, 0.5),
+        where=np.broadcast_to(spread > 0, values.shape)
+    )
@@ -1,10 +1,21 @@
+from collections import Counter
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.ad.schemas import *
-from src.config import get_db, get_redis
+from src.config import get_db, get_redis, settings
 from src.ad.services import *
-from src.ad.utils import get_ml_scores_from_redis
+from src.ad.utils import get_ml_scores, get_ml_scores_many, get_impressions_totals, incr_impressions_total, \
+    mark_views, unmark_views, get_cached_decision, cache_decision
+from src.ad.cache import active_campaigns
+from src.ad.procedures import select_best_campaign_sql
+from src.ad.ranking import CampaignRecord, Creative
+from src.time.state import worker_state
+from src.client.cache import client_profiles
+from src.stats.cache import publish_stats_changes
+from src.ad.events import publish_events, record_view, view_event, click_event
 from uuid import UUID
 from src.ad.models import AdViewModel
 router = APIRouter()
@@ -14,10 +25,10 @@ router = APIRouter()
             description="Возвращает рекламное объявление, подходящее для показа клиенту с учетом таргетинга и ML скора.")
 async def get_ads(
         client_id: UUID,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
         redis_db: redis.Redis = Depends(get_redis)
 ):
-    today = await redis_db.get("current_date")
+    today, campaigns_version = await worker_state.get(redis_db, "current_date", "campaigns_version")
     try:
         today = int(today)
     except:
@@ -25,66 +36,185 @@ async def get_ads(
             status_code=400,
             detail="Invalid date format"
         )
-    client = db.get(ClientModel, client_id)
-    if not client:
+
+    if settings.AD_DECISION_ENGINE == "sql":
+        client = await client_profiles.get(redis_db, db, client_id)
+        if not client:
+            raise HTTPException(
+                status_code=404,
+                detail="Client not found"
+            )
+
+        decision = await select_best_campaign_sql(db, client, today)
+        if decision is None:
+            return JSONResponse(
+                content={"message": "No ads available"},
+                status_code=404
+            )
+        best_campaign, creative = decision
+    else:
+        campaigns_version = int(campaigns_version or 0)
+        campaigns = await active_campaigns.get(today, campaigns_version)
+
+        # Повторный запрос клиента в тот же день и при той же версии кампаний обходится без ранжирования
+        best_campaign = None
+        if settings.AD_DECISION_TTL:
+            best_campaign = campaigns.get(await get_cached_decision(redis_db, client_id, today, campaigns_version))
+
+        if best_campaign is None:
+            client = await client_profiles.get(redis_db, db, client_id)
+            if not client:
+                raise HTTPException(
+                    status_code=404,
+                    detail="Client not found"
+                )
+
+            ml_scores = await get_ml_scores(redis_db, client.client_id)
+
+            impressions_totals = await get_impressions_totals(
+                redis_db, db, [campaign.campaign_id for campaign in campaigns.campaigns]
+            )
+
+            best_campaign = select_best_campaign(
+                ml_scores=ml_scores,
+                client=client,
+                active_campaigns=campaigns,
+                impressions_totals=impressions_totals
+            )
+
+            if not best_campaign:
+                return JSONResponse(
+                    content={"message": "No ads available"},
+                    status_code=404
+                )
+
+            if settings.AD_DECISION_TTL:
+                await cache_decision(redis_db, client_id, today, campaigns_version, best_campaign.campaign_id,
+                                     impressions_totals[campaigns.positions[best_campaign.campaign_id]])
+
+        creative = campaigns.creatives[best_campaign.campaign_id]
+
+    if settings.STATS_WRITE_BEHIND:
+        # Отметка показа, событие и счётчик показов — один вызов скрипта; лимит проверен при ранжировании
+        await record_view(redis_db, today, best_campaign, client_id)
+    else:
+        is_unique_view, = await mark_views(redis_db, db, today, [client_id])
+        if is_unique_view:
+            try:
+                new_view = AdViewModel(
+                    campaign_id=best_campaign.campaign_id,
+                    client_id=client_id,
+                    view_date=today,
+                )
+                db.add(new_view)
+                await update_campaign_stats(
+                    action=Action.VIEW,
+                    today=today,
+                    db=db,
+                    campaign=best_campaign,
+                    cost_per_impression=best_campaign.cost_per_impression,
+                    cost_per_click=best_campaign.cost_per_click,
+                )
+            except Exception:
+                await unmark_views(redis_db, today, [client_id])
+                raise
+            await publish_stats_changes(redis_db, db)
+            await incr_impressions_total(redis_db, best_campaign.campaign_id)
+
+    return ad_content(best_campaign, creative)
+
+
+@router.post("/ads/batch", tags=["Ads"], name="Получение рекламных объявлений для группы клиентов",
+             description="Возвращает рекламные объявления для списка клиентов за один запрос. "
+                         "Для неизвестных клиентов и клиентов без подходящей рекламы ad равен null.")
+async def get_ads_batch(
+        batch: AdBatchSchema,
+        db: AsyncSession = Depends(get_db),
+        redis_db: redis.Redis = Depends(get_redis)
+):
+    today, campaigns_version = await worker_state.get(redis_db, "current_date", "campaigns_version")
+    try:
+        today = int(today)
+    except:
         raise HTTPException(
-            status_code=404,
-            detail="Client not found"
+            status_code=400,
+            detail="Invalid date format"
         )
 
-    ml_scores = await get_ml_scores_from_redis(redis_db, str(client_id))
+    client_ids = list(dict.fromkeys(batch.client_ids))
+    clients = await client_profiles.get_many(redis_db, db, client_ids)
+    client_ids = [client_id for client_id in client_ids if client_id in clients]
 
-    if not ml_scores:
-        ml_scores = db.query(MLScoreModel).filter(MLScoreModel.client_id == client.client_id).all()
-        for ml in ml_scores:
-            await redis_db.set(f'ml_scores:{client.client_id}:{ml.advertiser_id}', str(ml.score))
+    ml_scores = await get_ml_scores_many(redis_db, client_ids)
 
-    best_campaign = select_best_campaign(
-        db=db,
-        ml_scores=ml_scores,
-        client=client,
-        current_date=today
+    campaigns = await active_campaigns.get(today, int(campaigns_version or 0))
+    impressions_totals = await get_impressions_totals(
+        redis_db, db, [campaign.campaign_id for campaign in campaigns.campaigns]
     )
 
-    if not best_campaign:
-        return JSONResponse(
-            content={"message": "No ads available"},
-            status_code=404
-        )
+    new_views = await mark_views(redis_db, db, today, client_ids)
 
-    is_unique_view = db.query(AdViewModel).filter(AdViewModel.client_id == client_id,
-                                                  AdViewModel.view_date == today).one_or_none()
-    if is_unique_view is None:
-        new_view = AdViewModel(
-            campaign_id=best_campaign.campaign_id,
-            client_id=client_id,
-            view_date=today,
+    # С этого момента при любой ошибке отметки снимаются, иначе показ клиенту за день уже не засчитается
+    try:
+        best_campaigns = select_best_campaigns(
+            ml_scores=ml_scores,
+            clients=[clients[client_id] for client_id in client_ids],
+            active_campaigns=campaigns,
+            impressions_totals=impressions_totals,
+            new_views=new_views
         )
-        db.add(new_view)
-        db.commit()
 
-        update_campaign_stats(
-            action=Action.VIEW,
-            today=today,
-            db=db,
-            campaign=best_campaign,
-            cost_per_impression=best_campaign.cost_per_impression,
-            cost_per_click=best_campaign.cost_per_click,
-        )
+        # Клиентам без рекламы показа не было, отметку снимаем
+        decided = list(zip(client_ids, best_campaigns, new_views))
+        served = [(client_id, best_campaign) for client_id, best_campaign, new_view in decided
+                  if best_campaign is not None and new_view]
+        await unmark_views(redis_db, today, [client_id for client_id, best_campaign, new_view in decided
+                                             if best_campaign is None and new_view])
 
-    return {
-        "ad_id": best_campaign.campaign_id,
-        "ad_title": best_campaign.ad_title,
-        "ad_text": best_campaign.ad_text,
-        "advertiser_id": best_campaign.advertiser_id
-    }
+        # Показы и статистика всей пачки одной транзакцией
+        views_per_campaign = Counter(best_campaign for _, best_campaign in served)
+        if settings.STATS_WRITE_BEHIND:
+            await publish_events(redis_db, [view_event(best_campaign, client_id, today)
+                                            for client_id, best_campaign in served])
+        else:
+            for client_id, best_campaign in served:
+                db.add(AdViewModel(
+                    campaign_id=best_campaign.campaign_id,
+                    client_id=client_id,
+                    view_date=today,
+                ))
+
+            await increment_daily_stats(db, [
+                dict(campaign_id=campaign.campaign_id, day=today, impressions_count=count, clicks_count=0,
+                     spent_impressions=campaign.cost_per_impression * count, spent_clicks=0)
+                for campaign, count in views_per_campaign.items()
+            ])
+            await db.commit()
+    except Exception:
+        await unmark_views(redis_db, today, [client_id for client_id, new_view in zip(client_ids, new_views)
+                                             if new_view])
+        raise
+    await publish_stats_changes(redis_db, db)
+
+    for campaign, count in views_per_campaign.items():
+        await incr_impressions_total(redis_db, campaign.campaign_id, count)
+
+    decisions = dict(zip(client_ids, best_campaigns))
+    return [
+        {
+            "client_id": client_id,
+            "ad": ad_content(decisions[client_id], campaigns.creatives[decisions[client_id].campaign_id])
+            if decisions.get(client_id) else None
+        }
+        for client_id in batch.client_ids
+    ]
 
 
 @router.post("/ads/{adsId}/click", tags=["Ads"], name="Фиксация перехода по рекламному объявлению",
              description="Фиксирует клик (переход) клиента по рекламному объявлению.", status_code=204)
-async def click_ad(adsId: UUID, client_id: AdClickSchema, db: Session = Depends(get_db),
+async def click_ad(adsId: UUID, client_id: AdClickSchema, db: AsyncSession = Depends(get_db),
                    redis_db: redis.Redis = Depends(get_redis)):
-    today = await redis_db.get("current_date")
+    today, = await worker_state.get(redis_db, "current_date")
     try:
         today = int(today)
     except:
@@ -92,17 +222,30 @@ async def click_ad(adsId: UUID, client_id: AdClickSchema, db: Session = Depends(
             status_code=400,
             detail="Invalid date format"
         )
-    campaign_existing = db.query(CampaignModel).filter(CampaignModel.campaign_id == adsId).first()
+    campaign_existing = await db.get(CampaignModel, adsId)
     if not campaign_existing:
         raise HTTPException(status_code=404, detail="Ad not found")
 
-    update_campaign_stats(
-        action=Action.CLICK,
-        today=today,
-        db=db,
-        campaign=campaign_existing,
-        cost_per_impression=float(str(campaign_existing.cost_per_impression)),
-        cost_per_click=float(str(campaign_existing.cost_per_click)),
-    )
+    if settings.STATS_WRITE_BEHIND:
+        await publish_events(redis_db, [click_event(campaign_existing, client_id.client_id, today)])
+    else:
+        await update_campaign_stats(
+            action=Action.CLICK,
+            today=today,
+            db=db,
+            campaign=campaign_existing,
+            cost_per_impression=float(str(campaign_existing.cost_per_impression)),
+            cost_per_click=float(str(campaign_existing.cost_per_click)),
+        )
+        await publish_stats_changes(redis_db, db)
 
     return {"client_id": str(client_id)}
+
+
+def ad_content(campaign: CampaignRecord, creative: Creative) -> dict:
+    return {
+        "ad_id": campaign.campaign_id,
+        "ad_title": creative.ad_title,
+        "ad_text": creative.ad_text,
+        "advertiser_id": campaign.advertiser_id
+    }
@@ -1,5 +1,12 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List
 import uuid
 
+from src.config import settings
+
 class AdClickSchema(BaseModel):
     client_id: uuid.UUID
+
+
+class AdBatchSchema(BaseModel):
+    client_ids: List[uuid.UUID] = Field(min_length=1, max_length=settings.ADS_BATCH_MAX_SIZE)
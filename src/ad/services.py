@@ -1,12 +1,15 @@
+import numpy as np
 import redis
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from typing import Dict, List, Type
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Optional, Sequence, Type, Union
+from uuid import UUID
 
 from src.advertiser.models import *
 from src.campaign.models import *
 from src.client.models import *
 from src.stats.models import *
+from src.ad.ranking import CampaignMatrix, CampaignRecord, DEFAULT_WEIGHTS
+from src.stats.services import increment_daily_stats
 
 
 # ========================
@@ -73,39 +76,53 @@ def calculate_campaign_metrics(
 # ========================
 
 def select_best_campaign(
-        db: Session,
-        ml_scores: List[MLScoreModel],
+        ml_scores: Dict[UUID, int],
         client: Type[ClientModel],
-        current_date: int):
-    active_campaigns = db.query(CampaignModel).filter(
-        CampaignModel.start_date <= current_date,
-        CampaignModel.end_date >= current_date,
-    ).all()
-
-    ml_score_map = {ml.advertiser_id: ml.score / 100 for ml in ml_scores}
-
-    ranked_campaigns = []
-    for campaign in active_campaigns:
-        total_views = db.query(func.sum(DailyStatsModel.impressions_count)).filter(
-            DailyStatsModel.campaign_id == campaign.campaign_id
-        ).scalar() or 0
-
-        is_violated = is_targeting_violated(client, campaign)
+        active_campaigns: CampaignMatrix,
+        impressions_totals: Sequence[int]):
+    if not len(active_campaigns):
+        return None
+
+    ml_score_map = {advertiser_id: score / 100 for advertiser_id, score in ml_scores.items()}
+    best = active_campaigns.rank(
+        ml_scores=active_campaigns.ml_scores(ml_score_map),
+        total_views=np.asarray(impressions_totals, dtype=np.float64),
+        is_violated=active_campaigns.is_violated(client),
+        weights=DEFAULT_WEIGHTS
+    )
 
-        metrics = calculate_campaign_metrics(
-            campaign=campaign,
-            ml_score=ml_score_map.get(campaign.advertiser_id, 0),
+    return active_campaigns.campaigns[best[0]] if len(best) else None
+
+
+def select_best_campaigns(
+        ml_scores: Sequence[Dict[UUID, int]],
+        clients: Sequence[Type[ClientModel]],
+        active_campaigns: CampaignMatrix,
+        impressions_totals: Sequence[int],
+        new_views: Sequence[bool]) -> List[Optional[CampaignRecord]]:
+    # Клиенты ранжируются по очереди на одном снапшоте; новые показы сразу
+    # учитываются в total_views, как при последовательных вызовах GET /ads
+    if not len(active_campaigns):
+        return [None] * len(clients)
+
+    total_views = np.array(impressions_totals, dtype=np.float64)
+    best_campaigns = []
+    for client_scores, client, new_view in zip(ml_scores, clients, new_views):
+        ml_score_map = {advertiser_id: score / 100 for advertiser_id, score in client_scores.items()}
+        best = active_campaigns.rank(
+            ml_scores=active_campaigns.ml_scores(ml_score_map),
             total_views=total_views,
-            is_targeting_violated=is_violated
+            is_violated=active_campaigns.is_violated(client),
+            weights=DEFAULT_WEIGHTS
         )
-        if metrics['penalties'] < 1.0:
-            ranked_campaigns.append(metrics)
-
-    if ranked_campaigns:
-        weights = {'profit': 0.5, 'relevance': 0.25, 'fulfillment': 0.15}
-        ranked_campaigns = normalize_metrics(ranked_campaigns, weights)
+        if not len(best):
+            best_campaigns.append(None)
+            continue
+        if new_view:
+            total_views[best[0]] += 1
+        best_campaigns.append(active_campaigns.campaigns[best[0]])
 
-    return ranked_campaigns[0]['campaign'] if ranked_campaigns else None
+    return best_campaigns
 
 
 def normalize_metrics(
@@ -146,44 +163,21 @@ class Action(Enum):
     CLICK = "CLICK"
 
 
-def update_campaign_stats(
+async def update_campaign_stats(
         action: Action,
         today: int,
-        db: Session,
-        campaign: Type[CampaignModel],
+        db: AsyncSession,
+        campaign: Union[CampaignRecord, CampaignModel],
         cost_per_impression: float,
         cost_per_click: float,
 ) -> None:
-    daily_stat = db.query(DailyStatsModel).filter(
-        DailyStatsModel.campaign_id == campaign.campaign_id,
-        DailyStatsModel.day == today
-    ).first()
-
     if action == Action.VIEW:
-        if daily_stat:
-            daily_stat.impressions_count += 1
-            daily_stat.spent_impressions += cost_per_impression
-        else:
-            db.add(DailyStatsModel(
-                campaign_id=campaign.campaign_id,
-                day=today,
-                impressions_count=1,
-                clicks_count=0,
-                spent_impressions=cost_per_impression,
-                spent_clicks=0
-            ))
+        increment = dict(impressions_count=1, clicks_count=0, spent_impressions=cost_per_impression, spent_clicks=0)
     elif action == Action.CLICK:
-        if daily_stat:
-            daily_stat.clicks_count += 1
-            daily_stat.spent_clicks += cost_per_click
-        else:
-            db.add(DailyStatsModel(
-                campaign_id=campaign.campaign_id,
-                day=today,
-                impressions_count=0,
-                clicks_count=1,
-                spent_impressions=0,
-                spent_clicks=cost_per_click
-            ))
-
-    db.commit()
+        increment = dict(impressions_count=0, clicks_count=1, spent_impressions=0, spent_clicks=cost_per_click)
+    else:
+        return
+
+    await increment_daily_stats(db, [dict(campaign_id=campaign.campaign_id, day=today, **increment)])
+    await db.commit()
+
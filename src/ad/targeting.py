@@ -0,0 +1,147 @@
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.campaign.models import LocationModel
+from src.config import Gender
+
+# (gender, min_age, max_age, location); None в поле означает «без ограничения»
+ParsedTargeting = Tuple[Optional[str], int, int, Optional[str]]
+# То же, но с кодом пола и id локации — в таком виде таргетинг хранится в campaign
+CompiledTargeting = Tuple[Optional[int], int, int, Optional[int]]
+
+# 0 — пол, которого нет в справочнике: такой таргетинг не совпадает ни с одним клиентом
+GENDER_CODES = {Gender.MALE: 1, Gender.FEMALE: 2, Gender.ALL: 3}
+
+
+def parse_targeting(targeting: Optional[dict]) -> ParsedTargeting:
+    # Те же правила, что и в is_targeting_violated
+    if targeting is None:
+        return None, 0, 1000, None
+    gender = targeting.get('gender', 'ALL')
+    return (
+        None if gender == 'ALL' else str(gender),
+        targeting.get('min_age', 0),
+        targeting.get('max_age', 1000),
+        targeting.get('location') or None,
+    )
+
+
+def gender_code(gender) -> int:
+    return GENDER_CODES.get(gender, 0)
+
+
+def compile_targeting(parsed: ParsedTargeting, location_id: Optional[int]) -> CompiledTargeting:
+    gender, min_age, max_age, location = parsed
+    return (
+        None if gender is None else gender_code(gender),
+        min_age,
+        max_age,
+        None if location is None else location_id,
+    )
+
+
+# ========================
+# WRITE-TIME COMPILATION
+# ========================
+
+async def intern_location(db: AsyncSession, name: str) -> int:
+    # DO UPDATE вместо DO NOTHING, чтобы RETURNING вернул id и для существующей локации
+    statement = insert(LocationModel).values(name=name)
+    return await db.scalar(statement.on_conflict_do_update(
+        index_elements=[LocationModel.name], set_={"name": statement.excluded.name}
+    ).returning(LocationModel.location_id))
+
+
+async def compiled_targeting_columns(db: AsyncSession, targeting: Optional[dict]) -> Dict[str, Optional[int]]:
+    # Значения колонок target_* кампании для сохраняемого JSON таргетинга
+    parsed = parse_targeting(targeting)
+    location = parsed[3]
+    location_id = await intern_location(db, location) if location is not None else None
+    gender, min_age, max_age, location_id = compile_targeting(parsed, location_id)
+    return {
+        "target_gender": gender,
+        "target_min_age": min_age,
+        "target_max_age": max_age,
+        "target_location_id": location_id,
+    }
+
+
+# ========================
+# TARGETING INVERTED INDEX
+# ========================
+
+class TargetingIndex:
+    """
+    Инвертированный индекс таргетинга снапшота кампаний.
+
+    Строится по скомпилированному таргетингу: для кода пола и id локации
+    хранит отсортированные массивы индексов кампаний, для возраста — границы диапазонов. Маска подходящих клиенту кампаний
+    собирается пересечением; маски кэшируются только для значений,
+    на которые есть таргетинг, остальным подходят лишь кампании без ограничения.
+    """
+
+    def __init__(self, compiled: Sequence[CompiledTargeting]):
+        self.size = len(compiled)
+
+        self.gender_any = np.fromiter((gender is None for gender, *_ in compiled), dtype=bool, count=self.size)
+        self.location_any = np.fromiter((location is None for *_, location in compiled), dtype=bool, count=self.size)
+        self.min_age = np.fromiter((min_age for _, min_age, _, _ in compiled), dtype=np.float64, count=self.size)
+        self.max_age = np.fromiter((max_age for _, _, max_age, _ in compiled), dtype=np.float64, count=self.size)
+
+        self.gender_ids: Dict[int, np.ndarray] = _postings(gender for gender, *_ in compiled)
+        self.location_ids: Dict[int, np.ndarray] = _postings(location for *_, location in compiled)
+
+        self._gender_masks: Dict[int, np.ndarray] = {}
+        self._location_masks: Dict[int, np.ndarray] = {}
+        self._age_masks: Dict[int, np.ndarray] = {}
+
+    def matching(self, gender: int, age: int, location: Optional[int]) -> np.ndarray:
+        # gender — код из GENDER_CODES, location — id локации или None, если на неё нет таргетинга
+        return self._gender_mask(gender) & self._age_mask(age) & self._location_mask(location)
+
+    def is_violated(self, gender: int, age: int, location: Optional[int]) -> np.ndarray:
+        return ~self.matching(gender, age, location)
+
+    def _gender_mask(self, gender: int) -> np.ndarray:
+        ids = self.gender_ids.get(gender)
+        if ids is None:
+            return self.gender_any
+        mask = self._gender_masks.get(gender)
+        if mask is None:
+            mask = _with_ids(self.gender_any, ids)
+            self._gender_masks[gender] = mask
+        return mask
+
+    def _location_mask(self, location: Optional[int]) -> np.ndarray:
+        ids = self.location_ids.get(location)
+        if ids is None:
+            return self.location_any
+        mask = self._location_masks.get(location)
+        if mask is None:
+            mask = _with_ids(self.location_any, ids)
+            self._location_masks[location] = mask
+        return mask
+
+    def _age_mask(self, age: int) -> np.ndarray:
+        mask = self._age_masks.get(age)
+        if mask is None:
+            mask = (self.min_age <= age) & (age <= self.max_age)
+            self._age_masks[age] = mask
+        return mask
+
+
+def _postings(values) -> Dict[int, np.ndarray]:
+    postings: Dict[int, List[int]] = {}
+    for i, value in enumerate(values):
+        if value is not None:
+            postings.setdefault(value, []).append(i)
+    return {value: np.array(ids, dtype=np.intp) for value, ids in postings.items()}
+
+
+def _with_ids(base: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    mask = base.copy()
+    mask[ids] = True
+    return mask
@@ -1,23 +1,314 @@
+import asyncio
 import redis.asyncio as redis
-from typing import List
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, TypeVar
+from uuid import UUID
+
+from src.ad.models import AdViewModel
 from src.advertiser.models import MLScoreModel
+from src.config import SessionLocal, settings
+from src.stats.models import DailyStatsModel
+
+T = TypeVar("T")
+
+# Скоры клиента одним хэшем: advertiser_id -> score
+ML_SCORES_KEY = "ml_scores:{client_id}"
+ML_SCORES_EMPTY_FIELD = "__empty__"
+
+# Версия скоров хранится в том же хэше и живёт вместе с ним; хэш из одной версии — промах кэша
+ML_SCORES_VERSION_FIELD = "__version__"
+
+# Загруженные из Postgres скоры кладутся в кэш, только если версия не менялась с начала загрузки:
+# иначе снимок, прочитанный до коммита нового скора, перезаписал бы инвалидацию
+STORE_ML_SCORES_SCRIPT = """
+local version = redis.call('HGET', KEYS[1], ARGV[1]) or ''
+if version ~= ARGV[2] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if version ~= '' then
+    redis.call('HSET', KEYS[1], ARGV[1], version)
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Инвалидация: скоры удаляются, версия растёт и остаётся в хэше на ML_SCORES_TTL —
+# дольше любой загрузки, начатой до инвалидации
+INVALIDATE_ML_SCORES_SCRIPT = """
+local version = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], ARGV[1], version)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return version
+"""
+
+# Поток показов и кликов при STATS_WRITE_BEHIND; сброшенные в Postgres события из него удаляются
+EVENTS_STREAM_KEY = "ad_events"
+
+# Живые счётчики показов по кампаниям за всё время: campaign_id -> impressions.
+# Хэш живёт IMPRESSIONS_TOTAL_TTL с первого прогрева и затем заново считается из daily_stat
+IMPRESSIONS_TOTAL_KEY = "impressions_total"
+
+# Увеличиваем только уже прогретый счётчик: отсутствующий будет
+# заново посчитан из daily_stat при следующем чтении
+INCR_IMPRESSIONS_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+return false
+"""
+
+# Клиенты, уже видевшие рекламу за день; маркер отличает прогретое пустое множество от отсутствующего.
+# Срока жизни нет: дни условные, множества прошедших дней удаляет /time/advance
+AD_VIEWS_KEY = "ad_views:{day}"
+AD_VIEWS_LOADED_MEMBER = "__loaded__"
+
+# ID потока событий, с которого начинается день: прогрев множества читает поток только с него
+AD_VIEWS_STREAM_START_KEY = "ad_views_stream_start"
+
+# 1 для новых клиентов, 0 для уже видевших; nil, если множество дня ещё не прогрето
+MARK_VIEWS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local added = {}
+for i, client_id in ipairs(ARGV) do
+    added[i] = redis.call('SADD', KEYS[1], client_id)
+end
+return added
+"""
+
+# Последнее решение по клиенту: day, version, campaign_id и число показов кампании на момент решения
+AD_DECISION_KEY = "ad_decision:{client_id}"
+
+# campaign_id, если решение принято в тот же день при той же версии кампаний
+# и кампания с тех пор набрала не больше ARGV[3] показов
+GET_DECISION_SCRIPT = """
+local decision = redis.call('HMGET', KEYS[1], 'day', 'version', 'campaign_id', 'impressions')
+if not decision[3] or decision[1] ~= ARGV[1] or decision[2] ~= ARGV[2] then
+    return false
+end
+local impressions = redis.call('HGET', KEYS[2], decision[3])
+if not impressions or tonumber(impressions) - tonumber(decision[4]) > tonumber(ARGV[3]) then
+    return false
+end
+return decision[3]
+"""
+
+_in_flight: Dict[str, asyncio.Future] = {}
+
+
+async def get_ml_scores(r: redis.Redis, client_id: UUID) -> Dict[UUID, int]:
+    cached = await r.hgetall(ML_SCORES_KEY.format(client_id=client_id))
+    if not _has_ml_scores(cached):
+        return await single_flight(f"ml_scores:{client_id}", lambda: load_ml_scores(r, client_id))
+
+    return _parse_ml_scores(cached)
+
+
+async def get_ml_scores_many(r: redis.Redis, client_ids: Sequence[UUID]) -> List[Dict[UUID, int]]:
+    # Хэши всех клиентов одним пайплайном, промахи догружаются параллельно
+    async with r.pipeline(transaction=False) as pipe:
+        for client_id in client_ids:
+            pipe.hgetall(ML_SCORES_KEY.format(client_id=client_id))
+        cached = await pipe.execute()
+
+    missing = [client_id for client_id, scores in zip(client_ids, cached) if not _has_ml_scores(scores)]
+    loaded = dict(zip(missing, await asyncio.gather(*(
+        single_flight(f"ml_scores:{client_id}", lambda client_id=client_id: load_ml_scores(r, client_id))
+        for client_id in missing
+    ))))
+
+    return [loaded[client_id] if client_id in loaded else _parse_ml_scores(scores)
+            for client_id, scores in zip(client_ids, cached)]
+
+
+def _has_ml_scores(cached: Dict[bytes, bytes]) -> bool:
+    return any(field != ML_SCORES_VERSION_FIELD.encode() for field in cached)
+
+
+def _parse_ml_scores(cached: Dict[bytes, bytes]) -> Dict[UUID, int]:
+    return {
+        UUID(advertiser_id): int(score)
+        for advertiser_id, score in ((field.decode(), value) for field, value in cached.items())
+        if advertiser_id not in (ML_SCORES_EMPTY_FIELD, ML_SCORES_VERSION_FIELD)
+    }
+
+
+async def load_ml_scores(r: redis.Redis, client_id: UUID) -> Dict[UUID, int]:
+    version = await r.hget(ML_SCORES_KEY.format(client_id=client_id), ML_SCORES_VERSION_FIELD)
+    async with SessionLocal() as session:
+        scores = dict((await session.execute(select(MLScoreModel.advertiser_id, MLScoreModel.score).where(
+            MLScoreModel.client_id == client_id
+        ))).all())
+
+    if scores:
+        fields = [value for advertiser_id, score in scores.items() for value in (str(advertiser_id), score)]
+        ttl = settings.ML_SCORES_TTL
+    else:
+        # Негативное кэширование: клиент без скоров не ходит в Postgres на каждый запрос
+        fields = [ML_SCORES_EMPTY_FIELD, 1]
+        ttl = settings.ML_SCORES_EMPTY_TTL
+
+    script = r.register_script(STORE_ML_SCORES_SCRIPT)
+    await script(
+        keys=[ML_SCORES_KEY.format(client_id=client_id)],
+        args=[ML_SCORES_VERSION_FIELD, version or b"", ttl, *fields]
+    )
+    return scores
+
 
-async def get_ml_scores_from_redis(r: redis.Redis, client_id: str) -> List[MLScoreModel]:
-    pattern = f"ml_scores:{client_id}:*"
-    keys = await r.keys(pattern)
-
-    response = []
-    for key in keys:
-        score = int(await r.get(key))
-        key = str(key)
-        advertiser_id = key.split(":")[2]
-
-        response.append(
-            MLScoreModel(
-                client_id=client_id,
-                advertiser_id=advertiser_id,
-                score=score,
-            )
+async def invalidate_ml_scores(r: redis.Redis, client_id: UUID) -> None:
+    # Вызывается после коммита: хэш удаляется, а загрузки, начатые до коммита, не смогут его записать
+    script = r.register_script(INVALIDATE_ML_SCORES_SCRIPT)
+    await script(keys=[ML_SCORES_KEY.format(client_id=client_id)],
+                 args=[ML_SCORES_VERSION_FIELD, settings.ML_SCORES_TTL])
+
+
+async def single_flight(key: str, load: Callable[[], Awaitable[T]]) -> T:
+    # Конкурентные промахи по одному ключу ждут одну загрузку в пределах воркера
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(load())
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def get_impressions_totals(r: redis.Redis, db: AsyncSession, campaign_ids: Sequence[UUID]) -> List[int]:
+    if not campaign_ids:
+        return []
+
+    cached = await r.hmget(IMPRESSIONS_TOTAL_KEY, [str(campaign_id) for campaign_id in campaign_ids])
+    missing = [campaign_id for campaign_id, total in zip(campaign_ids, cached) if total is None]
+    if not missing:
+        return [int(total) for total in cached]
+
+    loaded = dict.fromkeys(missing, 0)
+    loaded.update((await db.execute(
+        select(DailyStatsModel.campaign_id, func.sum(DailyStatsModel.impressions_count))
+        .where(DailyStatsModel.campaign_id.in_(missing))
+        .group_by(DailyStatsModel.campaign_id)
+    )).all())
+
+    # Показы, записанные между чтением суммы и HSETNX (и события, ещё не сброшенные из потока),
+    # в счётчик не попадут; срок жизни хэша ограничивает, сколько продержится такое расхождение
+    async with r.pipeline(transaction=False) as pipe:
+        for campaign_id, total in loaded.items():
+            pipe.hsetnx(IMPRESSIONS_TOTAL_KEY, str(campaign_id), int(total))
+        pipe.expire(IMPRESSIONS_TOTAL_KEY, settings.IMPRESSIONS_TOTAL_TTL, nx=True)
+        await pipe.execute()
+
+    return [int(total) if total is not None else int(loaded[campaign_id])
+            for campaign_id, total in zip(campaign_ids, cached)]
+
+
+async def incr_impressions_total(r: redis.Redis, campaign_id: UUID, amount: int = 1) -> None:
+    script = r.register_script(INCR_IMPRESSIONS_SCRIPT)
+    await script(keys=[IMPRESSIONS_TOTAL_KEY], args=[str(campaign_id), amount])
+
+
+async def mark_views(r: redis.Redis, db: AsyncSession, day: int, client_ids: Sequence[UUID]) -> List[bool]:
+    # True для клиентов, у которых это первый показ за день; отметка атомарна
+    if not client_ids:
+        return []
+
+    key = AD_VIEWS_KEY.format(day=day)
+    members = [str(client_id) for client_id in client_ids]
+    try:
+        script = r.register_script(MARK_VIEWS_SCRIPT)
+        added = await script(keys=[key], args=members)
+        if added is None:
+            await single_flight(key, lambda: load_views(r, day))
+            added = await script(keys=[key], args=members)
+        if added is not None:
+            return [bool(is_added) for is_added in added]
+    except redis.RedisError:
+        pass
+
+    # Точная проверка по ad_view, если Redis недоступен
+    viewed = set(await db.scalars(select(AdViewModel.client_id).where(AdViewModel.view_date == day,
+                                                                      AdViewModel.client_id.in_(client_ids))))
+    return [client_id not in viewed for client_id in client_ids]
+
+
+async def unmark_views(r: redis.Redis, day: int, client_ids: Sequence[UUID]) -> None:
+    # Снимает отметку с клиентов, показ которым так и не был записан
+    if not client_ids:
+        return
+    try:
+        await r.srem(AD_VIEWS_KEY.format(day=day), *(str(client_id) for client_id in client_ids))
+    except redis.RedisError:
+        pass
+
+
+async def load_views(r: redis.Redis, day: int) -> None:
+    # Сначала показы, ещё не сброшенные из потока: событие удаляется из него только после коммита
+    # в ad_view, поэтому при чтении в таком порядке ни один показ не теряется.
+    # Поток читается с начала дня порциями по EVENTS_BATCH_SIZE; начало неизвестно — с самого начала
+    start = await r.hget(AD_VIEWS_STREAM_START_KEY, day) or b"-"
+    pending = set()
+    while True:
+        entries = await r.xrange(EVENTS_STREAM_KEY, min=start, count=settings.EVENTS_BATCH_SIZE)
+        pending.update(
+            fields[b"client_id"].decode()
+            for _, fields in entries
+            if fields.get(b"action") == b"VIEW" and fields.get(b"day") == str(day).encode()
         )
+        if len(entries) < settings.EVENTS_BATCH_SIZE:
+            break
+        start = b"(" + entries[-1][0]
+
+    async with SessionLocal() as session:
+        viewed = (await session.scalars(select(AdViewModel.client_id).where(AdViewModel.view_date == day))).all()
+
+    key = AD_VIEWS_KEY.format(day=day)
+    await r.sadd(key, AD_VIEWS_LOADED_MEMBER, *pending, *(str(client_id) for client_id in viewed))
+
+
+async def mark_day_start(r: redis.Redis, day: int) -> None:
+    # Вызывается до смены current_date: ID событий нового дня будут не меньше записанного
+    seconds, microseconds = await r.time()
+    await r.hsetnx(AD_VIEWS_STREAM_START_KEY, day, f"{seconds * 1000 + microseconds // 1000}-0")
+
+
+async def clear_views_before(r: redis.Redis, day: int) -> None:
+    # Удаляет множества всех прошедших дней, включая пропущенные и заново прогретые отставшим воркером
+    stale = [key async for key in r.scan_iter(AD_VIEWS_KEY.format(day="*"))
+             if int(key.decode().rsplit(":", 1)[1]) < day]
+    if stale:
+        await r.delete(*stale)
+    past = [field for field in await r.hkeys(AD_VIEWS_STREAM_START_KEY) if int(field) < day]
+    if past:
+        await r.hdel(AD_VIEWS_STREAM_START_KEY, *past)
+
+
+async def get_cached_decision(r: redis.Redis, client_id: UUID, day: int, version: int) -> Optional[UUID]:
+    script = r.register_script(GET_DECISION_SCRIPT)
+    campaign_id = await script(
+        keys=[AD_DECISION_KEY.format(client_id=client_id), IMPRESSIONS_TOTAL_KEY],
+        args=[day, version, settings.AD_DECISION_MAX_STALE_IMPRESSIONS]
+    )
+    return UUID(campaign_id.decode()) if campaign_id else None
+
+
+async def cache_decision(r: redis.Redis, client_id: UUID, day: int, version: int, campaign_id: UUID,
+                         impressions: int) -> None:
+    key = AD_DECISION_KEY.format(client_id=client_id)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={"day": day, "version": version, "campaign_id": str(campaign_id),
+                                "impressions": impressions})
+        pipe.expire(key, settings.AD_DECISION_TTL)
+        await pipe.execute()
+
+
+async def invalidate_decision(r: redis.Redis, client_id: UUID) -> None:
+    await r.delete(AD_DECISION_KEY.format(client_id=client_id))
+
 
-    return response
\ No newline at end of file
+async def invalidate_decisions(r: redis.Redis, client_ids: Sequence[UUID]) -> None:
+    if client_ids:
+        await r.delete(*(AD_DECISION_KEY.format(client_id=client_id) for client_id in client_ids))
@@ -1,5 +1,5 @@
 import uuid
-from sqlalchemy import Column, VARCHAR, Integer, UUID, Float, ForeignKey
+from sqlalchemy import Column, VARCHAR, Integer, SmallInteger, UUID, Float, ForeignKey, Index
 from sqlalchemy.dialects.postgresql import JSONB
 
 from src.config import Base
@@ -9,16 +9,42 @@ class CampaignModel(Base):
     __tablename__ = 'campaign'
 
     campaign_id = Column(UUID(as_uuid=True), primary_key=True, unique=True, nullable=False, default=uuid.uuid4)
-    advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertiser.advertiser_id"), nullable=False)
+    advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertiser.advertiser_id"), nullable=False, index=True)
     impressions_limit = Column(Integer, nullable=False)
     clicks_limit = Column(Integer, nullable=False)
     cost_per_impression = Column(Float, nullable=False)
     cost_per_click = Column(Float, nullable=False)
     ad_title = Column(VARCHAR, nullable=False)
     ad_text = Column(VARCHAR, nullable=False)
-    start_date = Column(Integer, nullable=False, index=True)
+    start_date = Column(Integer, nullable=False)
     end_date = Column(Integer, nullable=False, index=True)
     targeting = Column(JSONB, nullable=True)
 
+    # Таргетинг, скомпилированный при создании и обновлении кампании; NULL — без ограничения
+    target_gender = Column(SmallInteger, nullable=True)
+    target_min_age = Column(Integer, nullable=False, default=0, server_default="0")
+    target_max_age = Column(Integer, nullable=False, default=1000, server_default="1000")
+    target_location_id = Column(Integer, ForeignKey("location.location_id"), nullable=True)
+
+    __table_args__ = (
+        # Активные на день кампании (start_date <= day <= end_date) отбираются по индексу целиком,
+        # без дочитывания и отбрасывания уже закончившихся
+        Index("ix_campaign_active_period", "start_date", "end_date"),
+    )
+
     def __repr__(self):
         return f"<CampaignModel(id={self.campaign_id}, title={self.ad_title})>" #pragma: no cover
+
+
+class LocationModel(Base):
+    __tablename__ = 'location'
+
+    location_id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(VARCHAR, nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"<LocationModel(id={self.location_id}, name={self.name})>" #pragma: no cover
+
+
+# Служебные колонки, которые не отдаются в API
+COMPILED_TARGETING_COLUMNS = {"target_gender", "target_min_age", "target_max_age", "target_location_id"}
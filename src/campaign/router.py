@@ -2,12 +2,18 @@ import httpx
 from fastapi import APIRouter
 from fastapi.encoders import jsonable_encoder
 from fastapi.params import Depends, Query
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.config import get_db, get_redis, settings
 from src.campaign.models import *
 from src.campaign.schemas import *
 from src.tools import *
 from src.advertiser.models import *
+from src.ad.cache import active_campaigns
+from src.ad.targeting import compiled_targeting_columns
+from src.ad.utils import IMPRESSIONS_TOTAL_KEY
+from src.stats.cache import advertiser_scope, bump_stats_versions, campaign_scope
+from src.time.state import worker_state
 import redis.asyncio as redis
 from uuid import UUID
 from pydantic import StrictBool
@@ -21,8 +27,9 @@ api_url = settings.API_URL
 async def post_advertiser_campaigns(advertiserId: UUID,
                                     campaign_data: CampaignSchema,
                                     isGenerate: StrictBool = Query(False),
-                                    db: Session = Depends(get_db)):
-    advertiser_existins = db.query(AdvertiserModel).filter(AdvertiserModel.advertiser_id == advertiserId).first()
+                                    db: AsyncSession = Depends(get_db),
+                                    redis_db: redis.Redis = Depends(get_redis)):
+    advertiser_existins = await db.get(AdvertiserModel, advertiserId)
     if not advertiser_existins:
         raise HTTPException(status_code=404, detail="Advertiser not found")
 
@@ -58,6 +65,7 @@ async def post_advertiser_campaigns(advertiserId: UUID,
         if llm_response["status"] != "accept":
             raise HTTPException(status_code=400, detail=f"Your ad text is not valid: {llm_response['reason']}")
 
+    targeting = jsonable_encoder(targeting_data) if targeting_data else None
     new_campaign = CampaignModel(
         advertiser_id=advertiserId,
         impressions_limit=campaign_data.impressions_limit,
@@ -68,46 +76,53 @@ async def post_advertiser_campaigns(advertiserId: UUID,
         ad_text=campaign_data.ad_text,
         start_date=campaign_data.start_date,
         end_date=campaign_data.end_date,
-        targeting=jsonable_encoder(targeting_data) if targeting_data else None,
+        targeting=targeting,
+        **await compiled_targeting_columns(db, targeting),
     )
     db.add(new_campaign)
-    db.commit()
-    db.refresh(new_campaign)
+    await db.commit()
+    await db.refresh(new_campaign)
 
-    return jsonable_encoder(new_campaign)
+    campaigns_version = await redis_db.incr("campaigns_version")
+    await worker_state.publish(redis_db, "campaigns_version", campaigns_version)
+    await active_campaigns.refresh_campaign(new_campaign.campaign_id, campaigns_version)
+    # Наличие кампаний меняет ответ статистики рекламодателя (404 -> нули)
+    await bump_stats_versions(redis_db, [advertiser_scope(advertiserId)])
+
+    return jsonable_encoder(new_campaign, exclude=COMPILED_TARGETING_COLUMNS)
 
 
 @router.get("/advertisers/{advertiserId}/campaigns", tags=["Campaigns"],
             name="Получение рекламных кампаний рекламодателя c пагинацией",
             description="Возвращает список рекламных кампаний для указанного рекламодателя с пагинацией.")
-def get_advertiser_campaigns(advertiserId: UUID,
+async def get_advertiser_campaigns(advertiserId: UUID,
                              size: Optional[int] = None,
                              page: Optional[int] = None,
-                             db: Session = Depends(get_db)):
-    campaign_list = db.query(CampaignModel).filter(CampaignModel.advertiser_id == advertiserId).all()
+                             db: AsyncSession = Depends(get_db)):
+    campaign_list = (await db.scalars(select(CampaignModel).where(CampaignModel.advertiser_id == advertiserId))).all()
     campaign_list = paginate(items=campaign_list, page=page, per_page=size)
-    return jsonable_encoder(campaign_list)
+    return jsonable_encoder(campaign_list, exclude=COMPILED_TARGETING_COLUMNS)
 
 
 @router.get("/advertisers/{advertiserId}/campaigns/{campaignId}", tags=["Campaigns"], name="Получение кампании по ID",
             description="Возвращает кампанию по ID.")
-def get_advertiser_campaign(advertiserId: UUID, campaignId: UUID, db: Session = Depends(get_db)):
-    campaign = db.query(CampaignModel).filter(CampaignModel.campaign_id == campaignId).one_or_none()
+async def get_advertiser_campaign(advertiserId: UUID, campaignId: UUID, db: AsyncSession = Depends(get_db)):
+    campaign = await db.get(CampaignModel, campaignId)
     if campaign is None or campaign.advertiser_id != advertiserId:
         raise HTTPException(status_code=404, detail="Campaign not found")
-    return jsonable_encoder(campaign)
+    return jsonable_encoder(campaign, exclude=COMPILED_TARGETING_COLUMNS)
 
 
 @router.put("/advertisers/{advertiserId}/campaigns/{campaignId}", tags=["Campaigns"],
             name="Обновление рекламной кампании",
             description="Обновляет разрешённые параметры рекламной кампании до её старта.")
 async def update_advertiser_campaign(advertiserId: UUID, campaignId: UUID, campaign_data: PutCampaignSchema,
-                                     db: Session = Depends(get_db), redis_db: redis.Redis = Depends(get_redis)):
-    campaign = db.query(CampaignModel).filter(CampaignModel.campaign_id == campaignId).one_or_none()
+                                     db: AsyncSession = Depends(get_db), redis_db: redis.Redis = Depends(get_redis)):
+    campaign = await db.get(CampaignModel, campaignId)
     if campaign is None or campaign.advertiser_id != advertiserId:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
-    today = await redis_db.get("current_date")
+    today, = await worker_state.get(redis_db, "current_date")
 
     today = int(today)
     isStarted = False
@@ -149,21 +164,36 @@ async def update_advertiser_campaign(advertiserId: UUID, campaignId: UUID, campa
         if llm_response["status"] != "accept":
             raise HTTPException(status_code=400, detail=f"Your ad text is not valid: {llm_response['reason']}")
         campaign.ad_text = campaign_data.ad_text
-    db.commit()
-    db.refresh(campaign)
 
-    return jsonable_encoder(campaign)
+    # Локация заносится в справочник только после проверки текста: запрос к LLM не держит блокировку строки location
+    for column, value in (await compiled_targeting_columns(db, campaign.targeting)).items():
+        setattr(campaign, column, value)
+    await db.commit()
+    await db.refresh(campaign)
+
+    campaigns_version = await redis_db.incr("campaigns_version")
+    await worker_state.publish(redis_db, "campaigns_version", campaigns_version)
+    await active_campaigns.refresh_campaign(campaign.campaign_id, campaigns_version)
+
+    return jsonable_encoder(campaign, exclude=COMPILED_TARGETING_COLUMNS)
 
 
 @router.delete("/advertisers/{advertiserId}/campaigns/{campaignId}", tags=["Campaigns"],
                name="Удаление рекламной кампании",
                description="Удаляет рекламную кампанию рекламодателя по заданному campaignId.", status_code=204)
-def delete_advertiser_campaign(advertiserId: UUID, campaignId: UUID, db: Session = Depends(get_db)):
-    campaign = db.query(CampaignModel).filter(CampaignModel.campaign_id == campaignId).one_or_none()
+async def delete_advertiser_campaign(advertiserId: UUID, campaignId: UUID, db: AsyncSession = Depends(get_db),
+                                     redis_db: redis.Redis = Depends(get_redis)):
+    campaign = await db.get(CampaignModel, campaignId)
     if campaign is None or campaign.advertiser_id != advertiserId:
         raise HTTPException(status_code=404, detail="Campaign not found")
 
-    db.delete(campaign)
-    db.commit()
+    await db.delete(campaign)
+    await db.commit()
+
+    await redis_db.hdel(IMPRESSIONS_TOTAL_KEY, str(campaignId))
+    campaigns_version = await redis_db.incr("campaigns_version")
+    await worker_state.publish(redis_db, "campaigns_version", campaigns_version)
+    await active_campaigns.refresh_campaign(campaignId, campaigns_version)
+    await bump_stats_versions(redis_db, [campaign_scope(campaignId), advertiser_scope(advertiserId)])
 
     return {"status": "ok"}
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence
+from uuid import UUID
+
+import redis.asyncio as redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.client.models import ClientModel
+from src.config import Gender, settings
+
+logger = logging.getLogger(__name__)
+
+# Профили всех клиентов одним хэшем: client_id -> "age|gender|location"
+CLIENT_PROFILES_KEY = "client_profiles"
+# Канал, в который /clients/bulk публикует изменённые client_id через запятую
+CLIENT_PROFILES_CHANNEL = "client_profiles"
+
+
+class ClientProfile(NamedTuple):
+    client_id: UUID
+    age: int
+    gender: Gender
+    location: str
+
+
+# ========================
+# CLIENT PROFILE CACHE
+# ========================
+
+class ClientProfileCache:
+    """
+    Двухуровневый кэш профилей клиентов для рекламного пути: LRU воркера и общий хэш в Redis.
+
+    Хэш в Redis обновляет /clients/bulk, он же рассылает изменённые id,
+    по которым воркеры вычищают свои LRU. Пока подписка не установлена,
+    LRU не используется и профили читаются из Redis.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._profiles: "OrderedDict[UUID, ClientProfile]" = OrderedDict()
+        self._generation = 0
+        self._synced = False
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    async def get(self, r: redis.Redis, db: AsyncSession, client_id: UUID) -> Optional[ClientProfile]:
+        return (await self.get_many(r, db, [client_id])).get(client_id)
+
+    async def get_many(self, r: redis.Redis, db: AsyncSession,
+                       client_ids: Sequence[UUID]) -> Dict[UUID, ClientProfile]:
+        profiles: Dict[UUID, ClientProfile] = {}
+        generation = self._generation
+        if self._synced:
+            for client_id in client_ids:
+                profile = self._profiles.get(client_id)
+                if profile is not None:
+                    self._profiles.move_to_end(client_id)
+                    profiles[client_id] = profile
+
+        missing = [client_id for client_id in client_ids if client_id not in profiles]
+        if missing:
+            loaded = await self._load(r, db, missing)
+            profiles.update(loaded)
+            self._remember(loaded.values(), generation)
+        return profiles
+
+    async def store(self, r: redis.Redis, profiles: Iterable[ClientProfile]) -> None:
+        # Вызывается после коммита: обновляет хэш и оповещает остальные воркеры
+        profiles = list(profiles)
+        if not profiles:
+            return
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.hset(CLIENT_PROFILES_KEY, mapping={
+                str(profile.client_id): _encode(profile) for profile in profiles
+            })
+            pipe.publish(CLIENT_PROFILES_CHANNEL, ",".join(str(profile.client_id) for profile in profiles))
+            await pipe.execute()
+        self.evict(profile.client_id for profile in profiles)
+
+    def evict(self, client_ids: Iterable[UUID]) -> None:
+        # Загрузки, начатые до вычистки, не кладут в LRU устаревшие профили
+        self._generation += 1
+        for client_id in client_ids:
+            self._profiles.pop(client_id, None)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._profiles.clear()
+
+    async def listen(self) -> None:
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        try:
+            while True:
+                try:
+                    async with r.pubsub() as pubsub:
+                        await pubsub.subscribe(CLIENT_PROFILES_CHANNEL)
+                        # Пока подписки не было, изменения могли быть пропущены
+                        self.clear()
+                        self._synced = True
+                        async for message in pubsub.listen():
+                            if message["type"] == "message":
+                                self.evict(UUID(client_id) for client_id in message["data"].decode().split(","))
+                except redis.RedisError:
+                    logger.exception("Client profile subscription lost")
+                finally:
+                    self._synced = False
+                await asyncio.sleep(1)
+        finally:
+            await r.aclose()
+
+    async def _load(self, r: redis.Redis, db: AsyncSession,
+                    client_ids: Sequence[UUID]) -> Dict[UUID, ClientProfile]:
+        cached = await r.hmget(CLIENT_PROFILES_KEY, [str(client_id) for client_id in client_ids])
+        profiles = {
+            client_id: _decode(client_id, value)
+            for client_id, value in zip(client_ids, cached) if value is not None
+        }
+
+        missing = [client_id for client_id in client_ids if client_id not in profiles]
+        if missing:
+            clients = await db.scalars(select(ClientModel).where(ClientModel.client_id.in_(missing)))
+            loaded = {
+                client.client_id: ClientProfile(client.client_id, client.age, client.gender, client.location)
+                for client in clients
+            }
+            if loaded:
+                # HSETNX: профиль, записанный /clients/bulk после нашего чтения из БД, не перетирается
+                async with r.pipeline(transaction=False) as pipe:
+                    for profile in loaded.values():
+                        pipe.hsetnx(CLIENT_PROFILES_KEY, str(profile.client_id), _encode(profile))
+                    await pipe.execute()
+            profiles.update(loaded)
+        return profiles
+
+    def _remember(self, profiles: Iterable[ClientProfile], generation: int) -> None:
+        if not self._synced or generation != self._generation:
+            return
+        for profile in profiles:
+            self._profiles[profile.client_id] = profile
+            self._profiles.move_to_end(profile.client_id)
+        while len(self._profiles) > self._max_size:
+            self._profiles.popitem(last=False)
+
+
+def _encode(profile: ClientProfile) -> str:
+    return f"{profile.age}|{profile.gender.value}|{profile.location}"
+
+
+def _decode(client_id: UUID, value: bytes) -> ClientProfile:
+    age, gender, location = value.decode().split("|", 2)
+    return ClientProfile(client_id, int(age), Gender(gender), location)
+
+
+client_profiles = ClientProfileCache(settings.CLIENT_CACHE_SIZE)
@@ -1,7 +1,10 @@
 from fastapi import APIRouter, HTTPException
 from fastapi.params import Depends
-from sqlalchemy.orm import Session
-from src.config import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+import redis.asyncio as redis
+from src.ad.utils import invalidate_decisions
+from src.config import get_db, get_redis
+from src.client.cache import ClientProfile, client_profiles
 from src.client.models import *
 from src.client.schemas import *
 from typing import List
@@ -10,8 +13,8 @@ router = APIRouter()
 
 @router.get("/clients/{clientId}", tags=["Clients"], name="Получение клиента по ID",
             description="Возвращает информацию о клиенте по его ID.")
-def get_client_by_id(clientId: UUID, db: Session = Depends(get_db)):
-    existing_client = db.query(ClientModel).filter(ClientModel.client_id == clientId).one_or_none()
+async def get_client_by_id(clientId: UUID, db: AsyncSession = Depends(get_db)):
+    existing_client = await db.get(ClientModel, clientId)
     if not existing_client:
         raise HTTPException(status_code=404, detail="Client not found")
     return existing_client
@@ -19,12 +22,15 @@ def get_client_by_id(clientId: UUID, db: Session = Depends(get_db)):
 
 @router.post("/clients/bulk", tags=["Clients"], status_code=201, name="Массовое создание/обновление клиентов",
              description="Создаёт новых или обновляет существующих клиентов.")
-def bulk(client_data: List[ClientSchema], db: Session = Depends(get_db)):
+async def bulk(client_data: List[ClientSchema], db: AsyncSession = Depends(get_db),
+               redis_db: redis.Redis = Depends(get_redis)):
+    updated_ids = []
     try:
         for client in client_data:
             client_id_uuid = client.client_id
-            existing_client = db.query(ClientModel).filter(ClientModel.client_id == client_id_uuid).one_or_none()
+            existing_client = await db.get(ClientModel, client_id_uuid)
             if existing_client:
+                updated_ids.append(client_id_uuid)
                 existing_client.login = client.login
                 existing_client.age = client.age
                 existing_client.location = client.location
@@ -38,9 +44,15 @@ def bulk(client_data: List[ClientSchema], db: Session = Depends(get_db)):
                     gender=client.gender,
                 )
                 db.add(new_client)
-        db.commit()
+        await db.commit()
     except:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail="Bulk data is not valid")
+
+    await client_profiles.store(redis_db, (
+        ClientProfile(client.client_id, client.age, client.gender, client.location) for client in client_data
+    ))
+    # Кэшированное решение принималось по старому таргетингу клиента
+    await invalidate_decisions(redis_db, updated_ids)
     return client_data
 
@@ -1,14 +1,18 @@
 import enum
 import os
 from dotenv import load_dotenv
+from fastapi import Request
 
 from pydantic_settings import BaseSettings
 from typing import ClassVar
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import NullPool
 
 import redis.asyncio as redis
+from redis import Redis as SyncRedis
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
@@ -22,9 +26,55 @@ class Settings(BaseSettings):
     port: ClassVar[str] = os.getenv("POSTGRES_PORT", "5432")
     dbname: ClassVar[str] = os.getenv("POSTGRES_DATABASE", "postgres")
 
+    # 0 отключает пул (NullPool), например для TestClient, где у каждого запроса свой event loop
+    POSTGRES_POOL_SIZE: ClassVar[int] = int(os.getenv("POSTGRES_POOL_SIZE", "10"))
+    POSTGRES_MAX_OVERFLOW: ClassVar[int] = int(os.getenv("POSTGRES_MAX_OVERFLOW", "20"))
+    POSTGRES_POOL_TIMEOUT: ClassVar[float] = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+    POSTGRES_POOL_RECYCLE: ClassVar[int] = int(os.getenv("POSTGRES_POOL_RECYCLE", "1800"))
+
     redis_host: ClassVar[str] = os.getenv("REDIS_HOST", "localhost")
     redis_port: ClassVar[int] = os.getenv("REDIS_PORT", "6379")
 
+    REDIS_MAX_CONNECTIONS: ClassVar[int] = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+    REDIS_SOCKET_TIMEOUT: ClassVar[float] = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+    REDIS_SOCKET_CONNECT_TIMEOUT: ClassVar[float] = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+    REDIS_HEALTH_CHECK_INTERVAL: ClassVar[int] = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+    ML_SCORES_TTL: ClassVar[int] = int(os.getenv("ML_SCORES_TTL", "3600"))
+    ML_SCORES_EMPTY_TTL: ClassVar[int] = int(os.getenv("ML_SCORES_EMPTY_TTL", "60"))
+
+    # Показы и клики пишутся в Redis Stream и сбрасываются в Postgres фоновым консьюмером
+    STATS_WRITE_BEHIND: ClassVar[bool] = os.getenv("STATS_WRITE_BEHIND", "0") == "1"
+    EVENTS_BATCH_SIZE: ClassVar[int] = int(os.getenv("EVENTS_BATCH_SIZE", "500"))
+    EVENTS_BLOCK_MS: ClassVar[int] = int(os.getenv("EVENTS_BLOCK_MS", "1000"))
+    EVENTS_CLAIM_IDLE_MS: ClassVar[int] = int(os.getenv("EVENTS_CLAIM_IDLE_MS", "60000"))
+    # Сколько секунд хранится id сброшенного события; повтор возможен, только пока оно в потоке
+    EVENTS_LEDGER_TTL: ClassVar[int] = int(os.getenv("EVENTS_LEDGER_TTL", "86400"))
+
+    # Число подстрок daily_stat на кампанию и день; 1 — без шардирования
+    STATS_SHARDS: ClassVar[int] = int(os.getenv("STATS_SHARDS", "1"))
+    STATS_COMPACT_INTERVAL: ClassVar[float] = float(os.getenv("STATS_COMPACT_INTERVAL", "60"))
+    # Сколько живёт закэшированный ответ эндпоинта статистики; устаревает он раньше — со сменой версии
+    STATS_CACHE_TTL: ClassVar[int] = int(os.getenv("STATS_CACHE_TTL", "3600"))
+    # Строк daily_stat в одном батче выгрузки (Arrow/Parquet); столько же читается из курсора за раз
+    STATS_EXPORT_BATCH_SIZE: ClassVar[int] = int(os.getenv("STATS_EXPORT_BATCH_SIZE", "10000"))
+
+    # Кэш решения по клиенту; 0 отключает. Решение переиспользуется, пока у выбранной
+    # кампании набралось не больше AD_DECISION_MAX_STALE_IMPRESSIONS новых показов
+    AD_DECISION_TTL: ClassVar[int] = int(os.getenv("AD_DECISION_TTL", "0"))
+    AD_DECISION_MAX_STALE_IMPRESSIONS: ClassVar[int] = int(os.getenv("AD_DECISION_MAX_STALE_IMPRESSIONS", "10"))
+
+    # Где GET /ads выбирает кампанию: memory — снапшот кампаний воркера,
+    # sql — одним запросом к функции rank_campaigns в Postgres
+    AD_DECISION_ENGINE: ClassVar[str] = os.getenv("AD_DECISION_ENGINE", "memory")
+
+    CLIENT_CACHE_SIZE: ClassVar[int] = int(os.getenv("CLIENT_CACHE_SIZE", "100000"))
+
+    # Как часто живые счётчики показов пересчитываются из daily_stat, исправляя накопленное расхождение
+    IMPRESSIONS_TOTAL_TTL: ClassVar[int] = int(os.getenv("IMPRESSIONS_TOTAL_TTL", "300"))
+
+    ADS_BATCH_MAX_SIZE: ClassVar[int] = int(os.getenv("ADS_BATCH_MAX_SIZE", "1000"))
+
     LLM_API_KEY: ClassVar[str] = os.getenv("LLM_API_KEY", "Undefined")
 
     API_URL: ClassVar[str] = os.getenv("API_URL", "http://localhost:8000")
@@ -34,6 +84,10 @@ class Settings(BaseSettings):
 
     @property
     def DATABASE_URL(self) -> str:
+        return f'postgresql+asyncpg://{self.username}:{self.password}@{self.host}:{self.port}/{self.dbname}'
+
+    @property
+    def SYNC_DATABASE_URL(self) -> str:
         return f'postgresql://{self.username}:{self.password}@{self.host}:{self.port}/{self.dbname}'
 
     @property
@@ -57,41 +111,112 @@ class Gender(str, enum.Enum):
 
 Base = declarative_base()
 
-engine = create_engine(
+
+def _pool_options() -> dict:
+    if settings.POSTGRES_POOL_SIZE <= 0:
+        return {"poolclass": NullPool}
+    return {
+        "pool_size": settings.POSTGRES_POOL_SIZE,
+        "max_overflow": settings.POSTGRES_MAX_OVERFLOW,
+        "pool_timeout": settings.POSTGRES_POOL_TIMEOUT,
+        "pool_recycle": settings.POSTGRES_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+engine = create_async_engine(
     settings.DATABASE_URL,
     echo=False,
-    pool_pre_ping=True
+    **_pool_options()
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Синхронный движок только для управления схемой (reset_db в тестах)
+sync_engine = create_engine(
+    settings.SYNC_DATABASE_URL,
+    echo=False,
+    pool_pre_ping=True
+)
 
 
-async def init_db():
-    Base.metadata.drop_all(bind=engine)
-    redis_db = redis.Redis.from_url(settings.REDIS_URL)  # pragma: no cover
-    await redis_db.set("current_date", 0)  # pragma: no cover
-    Base.metadata.create_all(bind=engine)  #pragma: no cover
+# Удаляет все ключи, кроме версий статистики: они только растут, а эпоха увеличивается,
+# чтобы ETag не повторились после сброса. Текущий день снова 0
+RESET_STATE_SCRIPT = """
+local cursor = '0'
+repeat
+    local reply = redis.call('SCAN', cursor, 'COUNT', 1000)
+    cursor = reply[1]
+    for _, key in ipairs(reply[2]) do
+        if key ~= KEYS[1] then
+            redis.call('DEL', key)
+        end
+    end
+until cursor == '0'
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('SET', KEYS[2], 0)
+"""
+
+
+async def init_db(redis_db: redis.Redis):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await redis_db.eval(*_reset_state())  # pragma: no cover
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)  #pragma: no cover
+
+
+async def get_db():
+    async with SessionLocal() as db:
+        try:
+            yield db
+        except Exception as e:
+            await db.rollback()
+            raise e
 
 
-def get_db():
-    db = SessionLocal()
+def reset_db():
+    Base.metadata.drop_all(bind=sync_engine)  # pragma: no cover
+    r = SyncRedis.from_url(settings.REDIS_URL)  # pragma: no cover
     try:
-        yield db
-    except Exception as e:
-        db.rollback()
-        raise e
+        r.eval(*_reset_state())
     finally:
-        db.close()
+        r.close()
+    Base.metadata.create_all(bind=sync_engine)  # pragma: no cover
 
 
-def reset_db():
-    Base.metadata.drop_all(bind=engine)  # pragma: no cover
-    Base.metadata.create_all(bind=engine)  # pragma: no cover
+def _reset_state():
+    # Всё, что выведено из данных Postgres, сбрасывается вместе со схемой: ключи Redis и кэши воркера.
+    # Импорт внутри: модули кэшей сами импортируют config
+    from src.ad.cache import active_campaigns
+    from src.client.cache import client_profiles
+    from src.stats.cache import STATS_EPOCH_FIELD, STATS_VERSION_KEY
+
+    active_campaigns.clear()
+    client_profiles.clear()
+    return RESET_STATE_SCRIPT, 2, STATS_VERSION_KEY, "current_date", STATS_EPOCH_FIELD
 
 
 #=====================================================================================
 
-async def get_redis():
+def create_redis_pool() -> redis.ConnectionPool:
+    # Один пул на воркер, создаётся в lifespan
+    return redis.ConnectionPool.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
+
+async def get_redis(request: Request):
+    pool = getattr(request.app.state, "redis_pool", None)
+    if pool is not None:
+        yield redis.Redis(connection_pool=pool)
+        return
+
+    # lifespan не запускался (например, TestClient без контекстного менеджера)
     r = redis.Redis.from_url(settings.REDIS_URL)
     try:
         yield r
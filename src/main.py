@@ -1,6 +1,7 @@
+import asyncio
 import uvicorn
 from fastapi import FastAPI
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 import redis.asyncio as redis
 
 from src.ad.router import router as ad_router
@@ -10,14 +11,33 @@ from src.campaign.router import router as campaign_router
 from src.stats.router import router as stats_router
 from src.time.router import router as time_router
 from src.llm_api.router import router as llm_api_router
-from src.config import get_db, get_redis, init_db, settings
+from src.ad.events import run_event_consumer
+from src.stats.services import run_stats_compaction
+from src.time.state import worker_state
+from src.client.cache import client_profiles
+from src.config import create_redis_pool, get_db, get_redis, init_db, settings
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
+    app.state.redis_pool = create_redis_pool()
+    await init_db(redis.Redis(connection_pool=app.state.redis_pool))
+
+    background_tasks = [asyncio.create_task(worker_state.listen()), asyncio.create_task(client_profiles.listen())]
+    if settings.STATS_WRITE_BEHIND:
+        background_tasks.append(asyncio.create_task(run_event_consumer()))
+    if settings.STATS_SHARDS > 1:
+        background_tasks.append(asyncio.create_task(run_stats_compaction()))
 
     yield
 
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    await app.state.redis_pool.aclose()
+    app.state.redis_pool = None
+
 app = FastAPI(lifespan=lifespan)
 
 # Include routers
@@ -0,0 +1,112 @@
+import re
+from typing import Awaitable, Callable, Iterable, Optional, Set
+from uuid import UUID
+
+import redis.asyncio as redis
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+
+# Версии статистики одним хэшем: "campaign:{id}" / "advertiser:{id}" -> номер версии.
+# Версии только растут и не сбрасываются, поэтому ETag никогда не повторяется
+STATS_VERSION_KEY = "stats_version"
+# Поле того же хэша: эпоха растёт при пересчёте свёрток и разом делает устаревшими все ETag
+STATS_EPOCH_FIELD = "epoch"
+# Готовый ответ эндпоинта статистики: "версия|JSON". Ключ строится только из того, что читает эндпоинт,
+# поэтому лишние или переставленные параметры запроса не плодят записи
+STATS_CACHE_KEY = "stats_cache:{endpoint}:{scope}:{params}"
+
+# entity-tag из RFC 9110: [W/]"…", внутри кавычек допустима и запятая
+_ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+# Ключ в Session.info, где копятся затронутые транзакцией версии до коммита
+_PENDING_VERSIONS = "stats_versions"
+
+
+def campaign_scope(campaign_id: UUID) -> str:
+    return f"campaign:{campaign_id}"
+
+
+def advertiser_scope(advertiser_id: UUID) -> str:
+    return f"advertiser:{advertiser_id}"
+
+
+# ========================
+# VERSIONS
+# ========================
+
+def track_stats_changes(db: AsyncSession, scopes: Iterable[str]) -> None:
+    # Версии увеличиваются только после коммита: иначе читатель мог бы
+    # закэшировать под новой версией ещё не закоммиченные данные
+    db.info.setdefault(_PENDING_VERSIONS, set()).update(scopes)
+
+
+async def publish_stats_changes(r: redis.Redis, db: AsyncSession) -> None:
+    # Вызывается после коммита сессии, записавшей статистику
+    await bump_stats_versions(r, db.info.pop(_PENDING_VERSIONS, ()))
+
+
+async def bump_stats_epoch(r: redis.Redis) -> None:
+    await r.hincrby(STATS_VERSION_KEY, STATS_EPOCH_FIELD, 1)
+
+
+async def bump_stats_versions(r: redis.Redis, scopes: Iterable[str]) -> None:
+    scopes = list(scopes)
+    if not scopes:
+        return
+    async with r.pipeline(transaction=False) as pipe:
+        for scope in scopes:
+            pipe.hincrby(STATS_VERSION_KEY, scope, 1)
+        await pipe.execute()
+
+
+# ========================
+# RESPONSE CACHE
+# ========================
+
+async def cached_stats_response(r: redis.Redis, request: Request, scope: str,
+                                compute: Callable[[], Awaitable], *params) -> Response:
+    # Версия и закэшированный ответ читаются одним пайплайном; агрегация — только при смене версии.
+    # params — значения параметров запроса, от которых зависит ответ, в фиксированном порядке
+    key = STATS_CACHE_KEY.format(endpoint=request.scope["endpoint"].__name__, scope=scope,
+                                 params=":".join("" if param is None else str(param) for param in params))
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.hmget(STATS_VERSION_KEY, STATS_EPOCH_FIELD, scope)
+        pipe.get(key)
+        (epoch, version), cached = await pipe.execute()
+
+    version = b"%d.%d" % (int(epoch or 0), int(version or 0))
+    etag = f'"{scope}:{version.decode()}"'
+    none_match = _none_match_tags(request.headers.get("if-none-match"))
+    if etag in none_match:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    if cached is not None:
+        cached_version, body = cached.split(b"|", 1)
+        if cached_version == version:
+            return _response(body, etag, none_match)
+
+    # Ошибки (404) не кэшируются и пробрасываются как есть
+    body = JSONResponse(content=jsonable_encoder(await compute())).body
+    # Если за время расчёта версия выросла, запись просто не совпадёт с ней при следующем чтении
+    await r.set(key, b"%s|%s" % (version, body), ex=settings.STATS_CACHE_TTL)
+    return _response(body, etag, none_match)
+
+
+def _response(body: bytes, etag: str, none_match: Set[str]) -> Response:
+    # "*" совпадает с любым существующим представлением, поэтому проверяется только после расчёта
+    if "*" in none_match:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def _none_match_tags(header: Optional[str]) -> Set[str]:
+    # If-None-Match сравнивается слабо: W/"x" совпадает с "x"
+    if header is None:
+        return set()
+    if header.strip() == "*":
+        return {"*"}
+    return set(_ENTITY_TAG.findall(header))
@@ -0,0 +1,119 @@
+from typing import AsyncIterator, List, Optional
+from uuid import UUID
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.campaign.models import CampaignModel
+from src.config import SessionLocal, settings
+from src.stats.models import DailyStatsModel
+from src.stats.services import COUNTER_COLUMNS, merged_daily_stats
+
+EXPORT_SCHEMA = pa.schema([
+    ("campaign_id", pa.string()),
+    ("advertiser_id", pa.string()),
+    ("day", pa.int32()),
+    ("impressions_count", pa.int64()),
+    ("clicks_count", pa.int64()),
+    ("spent_impressions", pa.float64()),
+    ("spent_clicks", pa.float64()),
+])
+
+EXPORT_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+# ========================
+# QUERY
+# ========================
+
+def export_query(advertiser_id: Optional[UUID], from_day: Optional[int], to_day: Optional[int]):
+    criteria = []
+    if advertiser_id is not None:
+        criteria.append(CampaignModel.advertiser_id == advertiser_id)
+    if from_day is not None:
+        criteria.append(DailyStatsModel.day >= from_day)
+    if to_day is not None:
+        criteria.append(DailyStatsModel.day <= to_day)
+
+    query = merged_daily_stats(*criteria)
+    return (
+        query.add_columns(CampaignModel.advertiser_id)
+        .join(CampaignModel, CampaignModel.campaign_id == DailyStatsModel.campaign_id)
+        .group_by(CampaignModel.advertiser_id)
+    )
+
+
+async def record_batches(advertiser_id: Optional[UUID] = None, from_day: Optional[int] = None,
+                         to_day: Optional[int] = None) -> AsyncIterator[pa.RecordBatch]:
+    # Своя сессия: ответ стримится уже после выхода из зависимостей эндпоинта.
+    # Строки читаются серверным курсором по STATS_EXPORT_BATCH_SIZE, в памяти — один батч
+    batch_size = settings.STATS_EXPORT_BATCH_SIZE
+    async with SessionLocal() as session:
+        result = await session.stream(export_query(advertiser_id, from_day, to_day)
+                                      .execution_options(yield_per=batch_size))
+        async for rows in result.partitions(batch_size):
+            yield _to_record_batch(rows)
+
+
+def _to_record_batch(rows) -> pa.RecordBatch:
+    columns = {
+        "campaign_id": [str(row.campaign_id) for row in rows],
+        "advertiser_id": [str(row.advertiser_id) for row in rows],
+        "day": [row.day for row in rows],
+    }
+    for name in COUNTER_COLUMNS:
+        columns[name] = [getattr(row, name) for row in rows]
+    return pa.RecordBatch.from_pydict(columns, schema=EXPORT_SCHEMA)
+
+
+# ========================
+# SERIALIZATION
+# ========================
+
+class _ChunkSink:
+    # Файловый объект для писателей pyarrow: накопленные байты забираются после каждого батча.
+    # tell() считает все записанные байты — Parquet пишет по нему смещения в футер
+    closed = False
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_export(fmt: str, batches: AsyncIterator[pa.RecordBatch]) -> AsyncIterator[bytes]:
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, EXPORT_SCHEMA)
+    else:
+        writer = pa.ipc.new_stream(sink, EXPORT_SCHEMA)
+
+    # В Parquet каждый батч становится отдельной row group, поэтому писатель не держит строки между батчами
+    async for batch in batches:
+        writer.write_batch(batch)
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
@@ -8,6 +8,22 @@ class DailyStatsModel(Base):
 
     campaign_id = Column(UUID(as_uuid=True), ForeignKey("campaign.campaign_id"), primary_key=True)
     day = Column(Integer, primary_key=True)
+    # Подстрока счётчика при STATS_SHARDS > 1, при чтении шарды суммируются
+    shard = Column(Integer, primary_key=True, default=0, server_default="0")
+    impressions_count = Column(Integer, nullable=False)
+    clicks_count = Column(Integer, nullable=False)
+    spent_impressions = Column(Float, nullable=False)
+    spent_clicks = Column(Float, nullable=False)
+
+
+class AdvertiserDailyStatsModel(Base):
+    # Сумма daily_stat по кампаниям рекламодателя, обновляется вместе с daily_stat
+    __tablename__ = "advertiser_daily_stat"
+
+    advertiser_id = Column(UUID(as_uuid=True), ForeignKey("advertiser.advertiser_id"), primary_key=True)
+    day = Column(Integer, primary_key=True)
+    # Шарды как у daily_stat: кампании одного рекламодателя не ждут блокировку одной строки
+    shard = Column(Integer, primary_key=True, default=0, server_default="0")
     impressions_count = Column(Integer, nullable=False)
     clicks_count = Column(Integer, nullable=False)
     spent_impressions = Column(Float, nullable=False)
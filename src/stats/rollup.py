@@ -0,0 +1,44 @@
+"""
+Обслуживание свёртки advertiser_daily_stat.
+
+    python -m src.stats.rollup verify   # сверить с daily_stat, код выхода 1 при расхождениях
+    python -m src.stats.rollup rebuild  # пересчитать заново по daily_stat
+"""
+import argparse
+import asyncio
+import sys
+
+import redis.asyncio as redis
+
+from src.config import SessionLocal, engine, settings
+from src.stats.cache import bump_stats_epoch
+from src.stats.services import rebuild_advertiser_daily_stats, verify_advertiser_daily_stats
+
+
+async def run(command: str) -> int:
+    try:
+        async with SessionLocal() as session:
+            if command == "rebuild":
+                await rebuild_advertiser_daily_stats(session)
+                # Счётчики могли измениться без смены версий: новая эпоха сбрасывает кэш и ETag клиентов
+                r = redis.Redis.from_url(settings.REDIS_URL)
+                try:
+                    await bump_stats_epoch(r)
+                finally:
+                    await r.aclose()
+                print("advertiser_daily_stat rebuilt")
+                return 0
+
+            drift = await verify_advertiser_daily_stats(session)
+            for advertiser_id, day, expected, stored in drift:
+                print(f"{advertiser_id} day={day}: expected={expected} stored={stored}")
+            print(f"{len(drift)} mismatched advertiser-day rows")
+            return 1 if drift else 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сверка и пересчёт advertiser_daily_stat")
+    parser.add_argument("command", choices=["verify", "rebuild"])
+    sys.exit(asyncio.run(run(parser.parse_args().command)))
@@ -1,9 +1,16 @@
 from sys import exc_info
-
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.config import get_db
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.config import get_db, get_redis
+from src.stats.cache import advertiser_scope, cached_stats_response, campaign_scope
+from src.stats.export import EXPORT_FORMATS, record_batches, stream_export
 from src.stats.models import *
+from src.stats.services import advertiser_daily_totals, advertiser_totals, campaign_totals, merged_daily_stats
 from src.campaign.models import *
 from src.advertiser.models import *
 from uuid import UUID
@@ -13,32 +20,28 @@ router = APIRouter()
 
 @router.get("/stats/campaigns/{campaignId}", tags=["Statistics"], name="Получение статистики по рекламной кампании",
             description="Возвращает агрегированную статистику (показы, переходы, затраты и конверсию) для заданной рекламной кампании.")
-def get_campaign_stats(campaignId: UUID, db: Session = Depends(get_db)):
-    campaign = db.query(CampaignModel).filter(CampaignModel.campaign_id == campaignId).first()
-    if not campaign:
-        raise HTTPException(status_code=404, detail="Campaign not found")
-    stats = db.query(DailyStatsModel).filter(DailyStatsModel.campaign_id == campaignId).all()
-    if not stats:
-        raise HTTPException(status_code=404, detail="Campaign stats not found")
+async def get_campaign_stats(campaignId: UUID, request: Request, db: AsyncSession = Depends(get_db),
+                             redis_db: redis.Redis = Depends(get_redis)):
+    return await cached_stats_response(redis_db, request, campaign_scope(campaignId),
+                                       lambda: _campaign_stats(db, campaignId))
 
-    total_impressions, total_clicks = 0, 0
-    spent_clicks_total, spent_impressions_total = 0, 0
 
-    for stat in stats:
-        total_impressions += stat.impressions_count
-        total_clicks += stat.clicks_count
-        spent_clicks_total += stat.spent_clicks
-        spent_impressions_total += stat.spent_impressions
+async def _campaign_stats(db: AsyncSession, campaignId: UUID):
+    totals = (await db.execute(campaign_totals(campaignId))).one_or_none()
+    if totals is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if not totals.stats_count:
+        raise HTTPException(status_code=404, detail="Campaign stats not found")
 
-    conversion = total_clicks / total_impressions * 100
-    spent_total = spent_clicks_total + spent_impressions_total
+    conversion = totals.clicks_count / totals.impressions_count * 100
+    spent_total = totals.spent_clicks + totals.spent_impressions
 
     return {
-        "impressions_count": total_impressions,
-        "clicks_count": total_clicks,
+        "impressions_count": totals.impressions_count,
+        "clicks_count": totals.clicks_count,
         "conversion": conversion,
-        "spent_impressions": spent_impressions_total,
-        "spent_clicks": spent_clicks_total,
+        "spent_impressions": totals.spent_impressions,
+        "spent_clicks": totals.spent_clicks,
         "spent_total": spent_total
     }
 
@@ -46,20 +49,20 @@ def get_campaign_stats(campaignId: UUID, db: Session = Depends(get_db)):
 @router.get("/stats/advertisers/{advertiserId}/campaigns/", tags=["Statistics"],
             name="Получение агрегированной статистики по всем кампаниям рекламодателя",
             description="Возвращает сводную статистику по всем рекламным кампаниям, принадлежащим заданному рекламодателю.")
-def get_advertiser_campaigns_stats(advertiserId: UUID, db: Session = Depends(get_db)):
-    advertiser = db.query(AdvertiserModel).filter(AdvertiserModel.advertiser_id == advertiserId).first()
-    if not advertiser:
+async def get_advertiser_campaigns_stats(advertiserId: UUID, request: Request, db: AsyncSession = Depends(get_db),
+                                         redis_db: redis.Redis = Depends(get_redis)):
+    return await cached_stats_response(redis_db, request, advertiser_scope(advertiserId),
+                                       lambda: _advertiser_campaigns_stats(db, advertiserId))
+
+
+async def _advertiser_campaigns_stats(db: AsyncSession, advertiserId: UUID):
+    totals = (await db.execute(advertiser_totals(advertiserId))).one_or_none()
+    if totals is None:
         raise HTTPException(status_code=404, detail="Advertiser not found")
-    campaigns = db.query(CampaignModel).filter(CampaignModel.advertiser_id == advertiserId).all()
-    if not campaigns:
+    if not totals.has_campaigns:
         raise HTTPException(status_code=404, detail="Advertiser campaigns not found")
 
-    stats = []
-    for campaign in campaigns:
-        stats += db.query(DailyStatsModel).filter(DailyStatsModel.campaign_id == campaign.campaign_id).all()
-    total_impressions, total_clicks = 0, 0
-    spent_clicks_total, spent_impressions_total = 0, 0
-    if not stats:
+    if not totals.stats_count:
         return {
             "impressions_count": 0,
             "clicks_count": 0,
@@ -68,24 +71,19 @@ def get_advertiser_campaigns_stats(advertiserId: UUID, db: Session = Depends(get
             "spent_clicks": 0,
             "spent_total": 0
         }
-    for stat in stats:
-        total_impressions += stat.impressions_count
-        total_clicks += stat.clicks_count
-        spent_clicks_total += stat.spent_clicks
-        spent_impressions_total += stat.spent_impressions
 
-    if total_impressions:
-        conversion = total_clicks / total_impressions * 100
+    if totals.impressions_count:
+        conversion = totals.clicks_count / totals.impressions_count * 100
     else:
         conversion = 0
-    spent_total = spent_clicks_total + spent_impressions_total
+    spent_total = totals.spent_clicks + totals.spent_impressions
 
     return {
-        "impressions_count": total_impressions,
-        "clicks_count": total_clicks,
+        "impressions_count": totals.impressions_count,
+        "clicks_count": totals.clicks_count,
         "conversion": conversion,
-        "spent_impressions": spent_impressions_total,
-        "spent_clicks": spent_clicks_total,
+        "spent_impressions": totals.spent_impressions,
+        "spent_clicks": totals.spent_clicks,
         "spent_total": spent_total
     }
 
@@ -93,11 +91,17 @@ def get_advertiser_campaigns_stats(advertiserId: UUID, db: Session = Depends(get
 @router.get("/stats/campaigns/{campaignId}/daily", tags=["Statistics"],
             name="Получение ежедневной статистики по рекламной кампании",
             description="Возвращает массив ежедневной статистики для указанной рекламной кампании.")
-def get_daily_stats(campaignId: UUID, db: Session = Depends(get_db)):
-    campaign = db.query(CampaignModel).filter(CampaignModel.campaign_id == campaignId).first()
+async def get_daily_stats(campaignId: UUID, request: Request, db: AsyncSession = Depends(get_db),
+                          redis_db: redis.Redis = Depends(get_redis)):
+    return await cached_stats_response(redis_db, request, campaign_scope(campaignId),
+                                       lambda: _daily_stats(db, campaignId))
+
+
+async def _daily_stats(db: AsyncSession, campaignId: UUID):
+    campaign = await db.get(CampaignModel, campaignId)
     if not campaign:
         raise HTTPException(status_code=404, detail="Campaign not found")
-    stats = db.query(DailyStatsModel).filter(DailyStatsModel.campaign_id == campaignId).all()
+    stats = (await db.execute(merged_daily_stats(DailyStatsModel.campaign_id == campaignId))).all()
     if not stats:
         raise HTTPException(status_code=404, detail="Campaign stats not found")
 
@@ -119,22 +123,51 @@ def get_daily_stats(campaignId: UUID, db: Session = Depends(get_db)):
 
 @router.get("/stats/advertisers/{advertiserId}/campaigns/daily", tags=["Statistics"],
             name="Получение ежедневной агрегированной статистики по всем кампаниям рекламодателя",
-            description="Возвращает массив ежедневной сводной статистики по всем рекламным кампаниям заданного рекламодателя.")
-def get_advertiser_campaigns_daily_stats(advertiserId: UUID, db: Session = Depends(get_db)):
-    campaigns = db.query(CampaignModel).filter(CampaignModel.advertiser_id == advertiserId).all()
-    if not campaigns:
-        raise HTTPException(status_code=404, detail="Advertiser campaigns not found")
-    response = []
-    for campaign in campaigns:
-        stats = db.query(DailyStatsModel).filter(DailyStatsModel.campaign_id == campaign.campaign_id).all()
-        for stat in stats:
-            response.append({
-                "impressions_count": stat.impressions_count,
-                "clicks_count": stat.clicks_count,
-                "spent_impressions": stat.spent_impressions,
-                "spent_clicks": stat.spent_clicks,
-                "spent_total": stat.spent_impressions + stat.spent_clicks,
-                "date": stat.day
-            })
+            description="Возвращает массив ежедневной сводной статистики по всем рекламным кампаниям заданного рекламодателя: "
+                        "одна строка на день, при необходимости в пределах from_day..to_day.")
+async def get_advertiser_campaigns_daily_stats(advertiserId: UUID, request: Request,
+                                               from_day: Optional[int] = Query(None, ge=0),
+                                               to_day: Optional[int] = Query(None, ge=0),
+                                               db: AsyncSession = Depends(get_db),
+                                               redis_db: redis.Redis = Depends(get_redis)):
+    # Диапазон дней входит в ключ кэша, версия общая для рекламодателя
+    return await cached_stats_response(redis_db, request, advertiser_scope(advertiserId),
+                                       lambda: _advertiser_campaigns_daily_stats(db, advertiserId, from_day, to_day),
+                                       from_day, to_day)
+
+
+async def _advertiser_campaigns_daily_stats(db: AsyncSession, advertiserId: UUID,
+                                            from_day: Optional[int], to_day: Optional[int]):
+    stats = (await db.execute(advertiser_daily_totals(advertiserId, from_day, to_day))).all()
+    if not stats:
+        # Пустой ответ отличаем от рекламодателя без кампаний только в этом случае
+        has_campaigns = await db.scalar(select(exists().where(CampaignModel.advertiser_id == advertiserId)))
+        if not has_campaigns:
+            raise HTTPException(status_code=404, detail="Advertiser campaigns not found")
 
-    return response
+    return [
+        {
+            "impressions_count": stat.impressions_count,
+            "clicks_count": stat.clicks_count,
+            "conversion": stat.clicks_count / stat.impressions_count * 100 if stat.impressions_count else 0,
+            "spent_impressions": stat.spent_impressions,
+            "spent_clicks": stat.spent_clicks,
+            "spent_total": stat.spent_impressions + stat.spent_clicks,
+            "date": stat.day
+        }
+        for stat in stats
+    ]
+
+
+@router.get("/stats/export", tags=["Statistics"], name="Выгрузка ежедневной статистики",
+            description="Потоково выгружает ежедневную статистику всех кампаний (или кампаний рекламодателя) "
+                        "в формате Arrow IPC stream или Parquet, при необходимости в пределах from_day..to_day.")
+async def export_daily_stats(format: str = Query("arrow", pattern="^(arrow|parquet)$"),
+                             advertiser_id: Optional[UUID] = Query(None),
+                             from_day: Optional[int] = Query(None, ge=0),
+                             to_day: Optional[int] = Query(None, ge=0)):
+    return StreamingResponse(
+        stream_export(format, record_batches(advertiser_id, from_day, to_day)),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="daily_stat.{format}"'}
+    )
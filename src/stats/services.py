@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import math
+import random
+from typing import Dict, List, Sequence, Set, Tuple
+from uuid import UUID
+
+import redis.asyncio as redis
+from sqlalchemy import Float, Integer, Uuid, column, delete, exists, func, literal, select, text, tuple_, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from src.config import SessionLocal, settings
+from src.campaign.models import CampaignModel
+from src.advertiser.models import AdvertiserModel
+from src.stats.cache import advertiser_scope, campaign_scope, track_stats_changes
+from src.stats.models import AdvertiserDailyStatsModel, DailyStatsModel
+
+logger = logging.getLogger(__name__)
+
+COUNTER_COLUMNS = ('impressions_count', 'clicks_count', 'spent_impressions', 'spent_clicks')
+
+
+# ========================
+# COUNTERS
+# ========================
+
+async def increment_daily_stats(db: AsyncSession, increments: Sequence[Dict]) -> None:
+    # Один INSERT ... ON CONFLICT DO UPDATE: счётчики увеличиваются в Postgres атомарно,
+    # без чтения строки и потерянных обновлений между воркерами
+    if not increments:
+        return
+
+    # Шард выбирается случайно, чтобы горячая кампания не упиралась в блокировку одной строки
+    rows = [dict(increment, shard=random.randrange(settings.STATS_SHARDS)) for increment in increments]
+
+    # Строки в порядке ключа, чтобы параллельные транзакции не ловили дедлоки
+    statement = insert(DailyStatsModel).values(
+        sorted(rows, key=lambda row: (row['campaign_id'], row['day'], row['shard'])))
+    await db.execute(_add_on_conflict(statement))
+    advertiser_ids = await _increment_advertiser_daily_stats(db, rows)
+
+    track_stats_changes(db, {campaign_scope(row['campaign_id']) for row in rows}
+                        | {advertiser_scope(advertiser_id) for advertiser_id in advertiser_ids})
+
+
+async def _increment_advertiser_daily_stats(db: AsyncSession, rows: Sequence[Dict]) -> Set[UUID]:
+    # Та же порция приращений, сложенная по рекламодателю и дню, в той же транзакции
+    increments = values(
+        column('campaign_id', Uuid()),
+        column('day', Integer),
+        *(column(name, Integer if name.endswith('_count') else Float) for name in COUNTER_COLUMNS),
+        name='increment'
+    ).data([(row['campaign_id'], row['day'], *(row[name] for name in COUNTER_COLUMNS)) for row in rows])
+
+    # Один случайный шард на транзакцию: параллельные транзакции расходятся по разным строкам
+    rollup = (
+        select(CampaignModel.advertiser_id, increments.c.day, literal(random.randrange(settings.STATS_SHARDS)),
+               *(func.sum(increments.c[name]) for name in COUNTER_COLUMNS))
+        .join_from(increments, CampaignModel, CampaignModel.campaign_id == increments.c.campaign_id)
+        .group_by(CampaignModel.advertiser_id, increments.c.day)
+        .order_by(CampaignModel.advertiser_id, increments.c.day)
+    )
+    statement = insert(AdvertiserDailyStatsModel).from_select(
+        ['advertiser_id', 'day', 'shard', *COUNTER_COLUMNS], rollup)
+    return set(await db.scalars(
+        _add_on_conflict(statement, AdvertiserDailyStatsModel).returning(AdvertiserDailyStatsModel.advertiser_id)))
+
+
+def merged_daily_stats(*criteria):
+    # Шарды одного дня кампании складываются при чтении
+    return (
+        select(
+            DailyStatsModel.campaign_id,
+            DailyStatsModel.day,
+            *(func.sum(getattr(DailyStatsModel, name)).label(name) for name in COUNTER_COLUMNS)
+        )
+        .where(*criteria)
+        .group_by(DailyStatsModel.campaign_id, DailyStatsModel.day)
+        .order_by(DailyStatsModel.campaign_id, DailyStatsModel.day)
+    )
+
+
+def campaign_totals(campaign_id):
+    # Одна строка, если кампания есть; stats_count = 0, если по ней ещё нет статистики
+    return (
+        select(
+            func.count(DailyStatsModel.campaign_id).label('stats_count'),
+            *_counter_sums(),
+        )
+        .select_from(CampaignModel)
+        .outerjoin(DailyStatsModel, DailyStatsModel.campaign_id == CampaignModel.campaign_id)
+        .where(CampaignModel.campaign_id == campaign_id)
+        .group_by(CampaignModel.campaign_id)
+    )
+
+
+def advertiser_totals(advertiser_id):
+    # Одна строка, если рекламодатель есть; has_campaigns и stats_count различают ответы 404 и нулевые итоги.
+    # Читается из advertiser_daily_stat: стоимость зависит только от числа дней
+    return (
+        select(
+            exists().where(CampaignModel.advertiser_id == AdvertiserModel.advertiser_id).label('has_campaigns'),
+            func.count(AdvertiserDailyStatsModel.day.distinct()).label('stats_count'),
+            *_counter_sums(AdvertiserDailyStatsModel),
+        )
+        .select_from(AdvertiserModel)
+        .outerjoin(AdvertiserDailyStatsModel, AdvertiserDailyStatsModel.advertiser_id == AdvertiserModel.advertiser_id)
+        .where(AdvertiserModel.advertiser_id == advertiser_id)
+        .group_by(AdvertiserModel.advertiser_id)
+    )
+
+
+def advertiser_daily_totals(advertiser_id, from_day=None, to_day=None):
+    # Строки advertiser_daily_stat по дням, шарды дня складываются при чтении
+    criteria = [AdvertiserDailyStatsModel.advertiser_id == advertiser_id]
+    if from_day is not None:
+        criteria.append(AdvertiserDailyStatsModel.day >= from_day)
+    if to_day is not None:
+        criteria.append(AdvertiserDailyStatsModel.day <= to_day)
+    return (
+        select(AdvertiserDailyStatsModel.day, *_counter_sums(AdvertiserDailyStatsModel))
+        .where(*criteria)
+        .group_by(AdvertiserDailyStatsModel.day)
+        .order_by(AdvertiserDailyStatsModel.day)
+    )
+
+
+def _counter_sums(model=DailyStatsModel):
+    return (func.sum(getattr(model, name)).label(name) for name in COUNTER_COLUMNS)
+
+
+# ========================
+# ADVERTISER ROLLUP
+# ========================
+
+def _advertiser_daily_stats_from_source():
+    # Эталонная свёртка advertiser_daily_stat, посчитанная заново по daily_stat
+    return (
+        select(CampaignModel.advertiser_id, DailyStatsModel.day, *_counter_sums())
+        .join(CampaignModel, CampaignModel.campaign_id == DailyStatsModel.campaign_id)
+        .group_by(CampaignModel.advertiser_id, DailyStatsModel.day)
+    )
+
+
+async def rebuild_advertiser_daily_stats(db: AsyncSession) -> None:
+    # Блокировка не даёт записи показов попасть между очисткой и пересчётом; пересчёт пишется в шард 0
+    await db.execute(text(f"LOCK TABLE {AdvertiserDailyStatsModel.__tablename__} IN EXCLUSIVE MODE"))
+    await db.execute(delete(AdvertiserDailyStatsModel))
+    await db.execute(insert(AdvertiserDailyStatsModel).from_select(
+        ['advertiser_id', 'day', *COUNTER_COLUMNS], _advertiser_daily_stats_from_source()))
+    await db.commit()
+
+
+async def verify_advertiser_daily_stats(db: AsyncSession) -> List[Tuple]:
+    # Расхождения (advertiser_id, day, ожидаемые счётчики, сохранённые счётчики); пустой список — свёртка верна
+    expected = {
+        (row.advertiser_id, row.day): tuple(row[2:])
+        for row in await db.execute(_advertiser_daily_stats_from_source())
+    }
+    stored = {
+        (row.advertiser_id, row.day): tuple(row[2:])
+        for row in await db.execute(
+            select(AdvertiserDailyStatsModel.advertiser_id, AdvertiserDailyStatsModel.day,
+                   *_counter_sums(AdvertiserDailyStatsModel))
+            .group_by(AdvertiserDailyStatsModel.advertiser_id, AdvertiserDailyStatsModel.day))
+    }
+    return [
+        (*key, expected.get(key), stored.get(key))
+        for key in sorted(expected.keys() | stored.keys())
+        if not _same_counters(expected.get(key), stored.get(key))
+    ]
+
+
+def _same_counters(expected, stored) -> bool:
+    if expected is None or stored is None:
+        return expected == stored
+    # Суммы float зависят от порядка сложения, поэтому траты сравниваются с допуском
+    return all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9) for a, b in zip(expected, stored))
+
+
+# ========================
+# COMPACTION
+# ========================
+
+async def compact_daily_stats(db: AsyncSession, before_day: int) -> None:
+    # Шарды прошедших дней daily_stat и advertiser_daily_stat сворачиваются в шард 0
+    for model in (DailyStatsModel, AdvertiserDailyStatsModel):
+        await db.execute(_fold_shards(model, before_day))
+    await db.commit()
+
+
+def _fold_shards(model, before_day: int):
+    # Один запрос: удалённые шарды складываются и добавляются к шарду 0.
+    # Строки сворачиваемых ключей, включая шард 0, сначала блокируются в порядке первичного ключа —
+    # том же, что у increment_daily_stats, — чтобы встречные блокировки с писателями не давали deadlock
+    keys = [key.name for key in model.__table__.primary_key if key.name != 'shard']
+    primary_key = list(model.__table__.primary_key)
+    sharded = aliased(model)
+    locked = (
+        select(*primary_key)
+        .where(model.day < before_day, exists().where(
+            sharded.shard != 0, *(getattr(sharded, name) == getattr(model, name) for name in keys)))
+        .order_by(*primary_key)
+        .with_for_update()
+        .cte('locked')
+    )
+    moved = (
+        delete(model)
+        .where(model.shard != 0, tuple_(*primary_key).in_(select(*locked.c)))
+        .returning(*(getattr(model, name) for name in (*keys, *COUNTER_COLUMNS)))
+        .cte('moved')
+    )
+    merged = (
+        select(*(moved.c[name] for name in keys), literal(0),
+               *(func.sum(moved.c[name]) for name in COUNTER_COLUMNS))
+        .group_by(*(moved.c[name] for name in keys))
+    )
+    statement = (
+        insert(model).from_select([*keys, 'shard', *COUNTER_COLUMNS], merged)
+        .add_cte(locked).add_cte(moved)
+    )
+    return _add_on_conflict(statement, model)
+
+
+async def run_stats_compaction() -> None:
+    r = redis.Redis.from_url(settings.REDIS_URL)
+    try:
+        while True:
+            await asyncio.sleep(settings.STATS_COMPACT_INTERVAL)
+            try:
+                today = await r.get("current_date")
+                if today is None:
+                    continue
+                async with SessionLocal() as session:
+                    await compact_daily_stats(session, int(today))
+            except Exception:
+                logger.exception("Failed to compact daily stats")
+    finally:
+        await r.aclose()
+
+
+def _add_on_conflict(statement, model=DailyStatsModel):
+    return statement.on_conflict_do_update(
+        index_elements=[key.name for key in model.__table__.primary_key],
+        set_={
+            name: getattr(model, name) + getattr(statement.excluded, name)
+            for name in COUNTER_COLUMNS
+        }
+    )
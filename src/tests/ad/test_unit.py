@@ -0,0 +1,721 @@
+import asyncio
+import random
+import unittest
+import uuid
+from datetime import timedelta
+from unittest.mock import patch
+
+import numpy as np
+import redis
+import redis.asyncio as aioredis
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select, text
+from src.main import app
+from src.config import reset_db, settings, Settings, SessionLocal
+from src.ad.cache import load_active_campaigns
+from src.ad.events import EVENTS_STREAM_KEY, consume_events, ensure_group, flush_events
+from src.ad.models import ProcessedEventModel
+from src.ad.ranking import CampaignMatrix, CampaignRecord, DEFAULT_WEIGHTS
+from src.ad.services import calculate_campaign_metrics, normalize_metrics, is_targeting_violated, \
+    update_campaign_stats, Action, select_best_campaign
+from src.ad.targeting import TargetingIndex, compile_targeting, compiled_targeting_columns, gender_code, \
+    parse_targeting
+from src.ad.utils import AD_VIEWS_KEY, AD_VIEWS_STREAM_START_KEY, IMPRESSIONS_TOTAL_KEY, ML_SCORES_KEY, \
+    get_ml_scores, invalidate_ml_scores, load_ml_scores
+from src.advertiser.models import AdvertiserModel, MLScoreModel
+from src.campaign.models import CampaignModel
+from src.client.models import ClientModel
+from src.stats.models import DailyStatsModel
+from src.config import Gender
+
+
+def reference_ranking(campaigns, ml_score_map, total_views, is_violated):
+    ranked = []
+    for campaign, views, violated in zip(campaigns, total_views, is_violated):
+        metrics = calculate_campaign_metrics(
+            campaign=campaign,
+            ml_score=ml_score_map.get(campaign.advertiser_id, 0),
+            total_views=views,
+            is_targeting_violated=violated
+        )
+        if metrics['penalties'] < 1.0:
+            ranked.append(metrics)
+    if ranked:
+        ranked = normalize_metrics(ranked, DEFAULT_WEIGHTS)
+    return [metrics['campaign'] for metrics in ranked]
+
+
+class AdTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        reset_db()
+        self.client = TestClient(app)
+        self.client_id = uuid.UUID("123e4567-e89b-12d3-a456-426614174000")
+        self.advertiser_id = uuid.UUID("133e4567-e89b-12d3-a456-426614174000")
+        redis_db = redis.Redis.from_url(settings.REDIS_URL)
+        redis_db.setnx("current_date", 0)
+        self.today = int(redis_db.get("current_date"))
+
+        self.client.post("/clients/bulk", json=[{
+            "client_id": str(self.client_id),
+            "login": "login",
+            "age": 30,
+            "gender": "Female",
+            "location": "Moscow"
+        }])
+        self.client.post("/advertisers/bulk", json=[
+            {"advertiser_id": str(self.advertiser_id), "name": "advertiser"}])
+
+    def create_clients(self, count):
+        client_ids = [str(uuid.uuid4()) for _ in range(count)]
+        self.client.post("/clients/bulk", json=[{
+            "client_id": client_id,
+            "login": "login",
+            "age": 30,
+            "gender": "Male",
+            "location": "Moscow"
+        } for client_id in client_ids])
+        return client_ids
+
+    def create_campaign(self, start_date, end_date, targeting=None, impressions_limit=1000, cost_per_impression=0.5,
+                        advertiser_id=None):
+        response = self.client.post(
+            f"/advertisers/{advertiser_id or self.advertiser_id}/campaigns",
+            params={"isGenerate": False},
+            json={
+                "ad_title": "Test Ad",
+                "ad_text": "Test text",
+                "impressions_limit": impressions_limit,
+                "clicks_limit": 100,
+                "cost_per_impression": cost_per_impression,
+                "cost_per_click": 1.0,
+                "start_date": start_date,
+                "end_date": end_date,
+                "targeting": targeting or {}
+            }
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()["campaign_id"]
+
+
+class TestAdEndpoints(AdTestCase):
+    def test_get_ads_after_campaign_create(self):
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 404)
+
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ad_id"], campaign_id)
+
+    def test_get_ads_after_campaign_delete(self):
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 404)
+
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        response = self.client.delete(f"/advertisers/{self.advertiser_id}/campaigns/{campaign_id}")
+        self.assertEqual(response.status_code, 204)
+
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_ads_after_time_advance(self):
+        campaign_id = self.create_campaign(self.today + 1, self.today + 1000)
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 404)
+
+        self.client.post("/time/advance", json={"current_date": self.today + 1})
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ad_id"], campaign_id)
+
+    def test_get_ads_respects_impressions_limit(self):
+        limited_id = self.create_campaign(0, self.today + 1000, impressions_limit=1, cost_per_impression=10)
+        fallback_id = self.create_campaign(0, self.today + 1000)
+
+        served = [
+            self.client.get("/ads", params={"client_id": client_id}).json()["ad_id"]
+            for client_id in self.create_clients(3)
+        ]
+        self.assertEqual(served, [limited_id, limited_id, fallback_id])
+
+    def test_get_ads_uses_updated_ml_scores(self):
+        other_advertiser_id = uuid.uuid4()
+        self.client.post("/advertisers/bulk", json=[
+            {"advertiser_id": str(other_advertiser_id), "name": "other"}])
+        first_id = self.create_campaign(0, self.today + 1000)
+        second_id = self.create_campaign(0, self.today + 1000, advertiser_id=other_advertiser_id)
+
+        # Без скоров кампании равны, побеждает меньший campaign_id
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.json()["ad_id"], str(min(uuid.UUID(first_id), uuid.UUID(second_id))))
+
+        self.client.post("/ml-scores", json={
+            "client_id": str(self.client_id),
+            "advertiser_id": str(other_advertiser_id),
+            "score": 100
+        })
+        response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(response.json()["ad_id"], second_id)
+
+    def test_stale_ml_scores_load_is_not_cached(self):
+        # Скор меняется, пока загрузка уже прочитала Postgres: снимок не должен попасть в кэш
+        client_id = self.client_id
+
+        async def load_racing_update():
+            r = aioredis.Redis.from_url(settings.REDIS_URL)
+
+            class UpdatedAfterRead:
+                async def __aenter__(self):
+                    self.session = SessionLocal()
+                    return await self.session.__aenter__()
+
+                async def __aexit__(self, *exc_info):
+                    await self.session.__aexit__(*exc_info)
+                    await invalidate_ml_scores(r, client_id)
+
+            try:
+                await r.delete(ML_SCORES_KEY.format(client_id=client_id))
+                with patch("src.ad.utils.SessionLocal", UpdatedAfterRead):
+                    await load_ml_scores(r, client_id)
+                await get_ml_scores(r, client_id)
+            finally:
+                await r.aclose()
+
+        # В хэше осталась только версия, поэтому следующее чтение снова идёт в Postgres
+        with patch("src.ad.utils.load_ml_scores", return_value={}) as reload:
+            asyncio.run(load_racing_update())
+        reload.assert_called_once()
+        # Версия не копится бессрочно: хэш с ней истекает
+        self.assertGreater(redis.Redis.from_url(settings.REDIS_URL).ttl(ML_SCORES_KEY.format(client_id=client_id)), 0)
+
+    def test_get_ads_uses_updated_client_profile(self):
+        targeted_id = self.create_campaign(0, self.today + 1000, targeting={"location": "Paris"},
+                                           cost_per_impression=0.52)
+        untargeted_id = self.create_campaign(0, self.today + 1000)
+        client_ids = self.create_clients(2)
+
+        response = self.client.get("/ads", params={"client_id": client_ids[0]})
+        self.assertEqual(response.json()["ad_id"], untargeted_id)
+
+        self.client.post("/clients/bulk", json=[{
+            "client_id": client_ids[1],
+            "login": "login",
+            "age": 30,
+            "gender": "Male",
+            "location": "Paris"
+        }])
+        response = self.client.get("/ads", params={"client_id": client_ids[1]})
+        self.assertEqual(response.json()["ad_id"], targeted_id)
+
+    def test_get_ads_unknown_client(self):
+        response = self.client.get("/ads", params={"client_id": str(uuid.uuid4())})
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_ads_batch_respects_impressions_limit(self):
+        limited_id = self.create_campaign(0, self.today + 1000, impressions_limit=1, cost_per_impression=10)
+        fallback_id = self.create_campaign(0, self.today + 1000)
+        client_ids = self.create_clients(3)
+        unknown_id = str(uuid.uuid4())
+
+        response = self.client.post("/ads/batch", json={"client_ids": client_ids + [unknown_id, client_ids[0]]})
+        self.assertEqual(response.status_code, 200)
+        served = [item["ad"]["ad_id"] if item["ad"] else None for item in response.json()]
+        self.assertEqual(served, [limited_id, limited_id, fallback_id, None, limited_id])
+
+        response = self.client.get(f"/stats/campaigns/{limited_id}")
+        self.assertEqual(response.json()["impressions_count"], 2)
+        response = self.client.get(f"/stats/campaigns/{fallback_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+    def test_get_ads_batch_skips_seen_clients(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+
+        response = self.client.post("/ads/batch", json={"client_ids": [str(self.client_id)]})
+        self.assertEqual(response.json()[0]["ad"]["ad_id"], campaign_id)
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+    def test_get_ads_batch_failure_keeps_view_unrecorded(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        with patch("src.ad.router.select_best_campaigns", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/ads/batch", json={"client_ids": [str(self.client_id)]})
+
+        self.client.post("/ads/batch", json={"client_ids": [str(self.client_id)]})
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+    def test_impressions_totals_are_reseeded_after_expiry(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        client_ids = self.create_clients(2)
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        r.delete(IMPRESSIONS_TOTAL_KEY)
+
+        self.client.get("/ads", params={"client_id": client_ids[0]})
+        self.assertTrue(0 < r.ttl(IMPRESSIONS_TOTAL_KEY) <= settings.IMPRESSIONS_TOTAL_TTL)
+
+        # Расхождение живёт не дольше хэша: после истечения счётчик снова берётся из daily_stat
+        r.hset(IMPRESSIONS_TOTAL_KEY, campaign_id, 100)
+        r.delete(IMPRESSIONS_TOTAL_KEY)
+        self.client.get("/ads", params={"client_id": client_ids[1]})
+        self.assertEqual(int(r.hget(IMPRESSIONS_TOTAL_KEY, campaign_id)), 2)
+
+    def test_get_ads_counts_one_view_per_day(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        for _ in range(3):
+            self.client.get("/ads", params={"client_id": str(self.client_id)})
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+        self.client.post("/time/advance", json={"current_date": self.today + 1})
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 2)
+
+    def test_advance_sweeps_all_past_view_sets(self):
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        # Множество давно прошедшего дня, заново прогретое отставшим воркером
+        r.sadd(AD_VIEWS_KEY.format(day=self.today - 2), "client")
+        r.sadd(AD_VIEWS_KEY.format(day=self.today), "client")
+
+        self.client.post("/time/advance", json={"current_date": self.today + 2})
+        self.assertEqual(r.exists(AD_VIEWS_KEY.format(day=self.today - 2), AD_VIEWS_KEY.format(day=self.today)), 0)
+
+    def test_get_ads_view_dedupe_survives_redis_flush(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        redis.Redis.from_url(settings.REDIS_URL).delete(AD_VIEWS_KEY.format(day=self.today))
+
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+    def test_concurrent_stats_updates_are_not_lost(self):
+        campaign = CampaignModel(campaign_id=uuid.UUID(self.create_campaign(0, self.today + 1000)))
+
+        async def record(action):
+            async with SessionLocal() as session:
+                await update_campaign_stats(action, self.today, session, campaign, 0.5, 1.0)
+
+        async def record_all():
+            await asyncio.gather(*(record(Action.VIEW) for _ in range(20)),
+                                 *(record(Action.CLICK) for _ in range(5)))
+
+        asyncio.run(record_all())
+        response = self.client.get(f"/stats/campaigns/{campaign.campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 20)
+        self.assertEqual(response.json()["clicks_count"], 5)
+        self.assertEqual(response.json()["spent_total"], 15.0)
+
+    def test_get_ads_batch_validation(self):
+        response = self.client.post("/ads/batch", json={"client_ids": []})
+        self.assertEqual(response.status_code, 422)
+
+    def test_reset_db_drops_derived_redis_state(self):
+        self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        self.assertTrue(r.exists(ML_SCORES_KEY.format(client_id=self.client_id)))
+
+        reset_db()
+        self.assertEqual(r.exists(ML_SCORES_KEY.format(client_id=self.client_id), IMPRESSIONS_TOTAL_KEY), 0)
+        self.assertEqual(int(r.get("current_date")), 0)
+
+
+class TestWriteBehindStats(AdTestCase):
+    def run(self, result=None):
+        with patch.object(Settings, "STATS_WRITE_BEHIND", True):
+            return super().run(result)
+
+    def consume(self):
+        async def consume():
+            r = aioredis.Redis.from_url(settings.REDIS_URL)
+            try:
+                await ensure_group(r)
+                while await consume_events(r, "test"):
+                    pass
+            finally:
+                await r.aclose()
+
+        asyncio.run(consume())
+
+    def test_views_and_clicks_are_flushed(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.client.post(f"/ads/{campaign_id}/click", json={"client_id": str(self.client_id)})
+
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.status_code, 404)
+
+        self.consume()
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+        self.assertEqual(response.json()["clicks_count"], 1)
+        self.assertEqual(response.json()["spent_total"], 1.5)
+
+    def test_repeated_view_is_recorded_once(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        for _ in range(3):
+            response = self.client.get("/ads", params={"client_id": str(self.client_id)})
+            self.assertEqual(response.json()["ad_id"], campaign_id)
+
+        self.assertEqual(len(r.xrange(EVENTS_STREAM_KEY)), 1)
+        self.assertEqual(int(r.hget(IMPRESSIONS_TOTAL_KEY, campaign_id)), 1)
+        self.assertTrue(r.sismember(AD_VIEWS_KEY.format(day=self.today), str(self.client_id)))
+
+    def test_view_dedupe_reloads_unflushed_views(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(r.ttl(AD_VIEWS_KEY.format(day=self.today)), -1)
+
+        # Множество дня потеряно, а показ ещё в потоке и не попал в ad_view
+        r.delete(AD_VIEWS_KEY.format(day=self.today))
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.assertEqual(len(r.xrange(EVENTS_STREAM_KEY)), 1)
+
+        self.consume()
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+    def test_view_dedupe_reload_reads_stream_from_day_start(self):
+        self.create_campaign(0, self.today + 1000)
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        self.client.post("/time/advance", json={"current_date": self.today + 1})
+        self.assertIsNotNone(r.hget(AD_VIEWS_STREAM_START_KEY, self.today + 1))
+
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        r.delete(AD_VIEWS_KEY.format(day=self.today + 1))
+        with patch.object(Settings, "EVENTS_BATCH_SIZE", 1):
+            self.client.get("/ads", params={"client_id": str(self.client_id)})
+        # Вчерашний показ ещё в потоке, сегодняшний не задублирован
+        self.assertEqual(len(r.xrange(EVENTS_STREAM_KEY)), 2)
+
+    def test_replayed_events_are_applied_once(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        entries = redis.Redis.from_url(settings.REDIS_URL).xrange(EVENTS_STREAM_KEY)
+        self.assertEqual(len(entries), 1)
+
+        asyncio.run(flush_events(entries))
+        asyncio.run(flush_events(entries))
+        self.consume()
+
+        response = self.client.get(f"/stats/campaigns/{campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 1)
+
+
+    def test_flush_prunes_ledger_by_insertion_time(self):
+        self.create_campaign(0, self.today + 1000)
+        self.client.get("/ads", params={"client_id": str(self.client_id)})
+        stale_id, fresh_id = uuid.uuid4(), uuid.uuid4()
+
+        async def insert_ledger():
+            async with SessionLocal() as session:
+                session.add_all([
+                    ProcessedEventModel(event_id=stale_id, created_at=func.now() - timedelta(days=2)),
+                    ProcessedEventModel(event_id=fresh_id),
+                ])
+                await session.commit()
+
+        async def ledger_ids():
+            async with SessionLocal() as session:
+                return set(await session.scalars(select(ProcessedEventModel.event_id)))
+
+        asyncio.run(insert_ledger())
+        self.consume()
+        ledger = asyncio.run(ledger_ids())
+        self.assertNotIn(stale_id, ledger)
+        self.assertIn(fresh_id, ledger)
+
+class TestAdDecisionCache(AdTestCase):
+    def run(self, result=None):
+        with patch.object(Settings, "AD_DECISION_TTL", 60), \
+                patch.object(Settings, "AD_DECISION_MAX_STALE_IMPRESSIONS", 1):
+            return super().run(result)
+
+    def get_ad(self, client_id=None):
+        return self.client.get("/ads", params={"client_id": str(client_id or self.client_id)}).json()["ad_id"]
+
+    def test_repeat_request_skips_ranking(self):
+        campaign_id = self.create_campaign(0, self.today + 1000)
+        with patch("src.ad.router.select_best_campaign", wraps=select_best_campaign) as ranking:
+            self.assertEqual(self.get_ad(), campaign_id)
+            self.assertEqual(self.get_ad(), campaign_id)
+        self.assertEqual(ranking.call_count, 1)
+
+    def test_invalidated_by_campaign_change(self):
+        self.create_campaign(0, self.today + 1000)
+        self.get_ad()
+        better_id = self.create_campaign(0, self.today + 1000, cost_per_impression=10)
+        self.assertEqual(self.get_ad(), better_id)
+
+    def test_invalidated_by_ml_scores(self):
+        other_advertiser_id = uuid.uuid4()
+        self.client.post("/advertisers/bulk", json=[
+            {"advertiser_id": str(other_advertiser_id), "name": "other"}])
+        self.create_campaign(0, self.today + 1000)
+        second_id = self.create_campaign(0, self.today + 1000, advertiser_id=other_advertiser_id)
+        self.get_ad()
+
+        self.client.post("/ml-scores", json={
+            "client_id": str(self.client_id),
+            "advertiser_id": str(other_advertiser_id),
+            "score": 100
+        })
+        self.assertEqual(self.get_ad(), second_id)
+
+    def test_invalidated_by_client_profile(self):
+        targeted_id = self.create_campaign(0, self.today + 1000, targeting={"location": "Paris"},
+                                           cost_per_impression=0.52)
+        untargeted_id = self.create_campaign(0, self.today + 1000)
+        self.assertEqual(self.get_ad(), untargeted_id)
+
+        self.client.post("/clients/bulk", json=[{
+            "client_id": str(self.client_id),
+            "login": "login",
+            "age": 30,
+            "gender": "Female",
+            "location": "Paris"
+        }])
+        self.assertEqual(self.get_ad(), targeted_id)
+
+    def test_stale_after_impressions_budget(self):
+        limited_id = self.create_campaign(0, self.today + 1000, impressions_limit=1, cost_per_impression=10)
+        fallback_id = self.create_campaign(0, self.today + 1000)
+        self.assertEqual(self.get_ad(), limited_id)
+        for client_id in self.create_clients(2):
+            self.get_ad(client_id)
+        self.assertEqual(self.get_ad(), fallback_id)
+
+
+class TestRankingEngine(unittest.TestCase):
+    def setUp(self) -> None:
+        self.random = random.Random(42)
+        self.advertiser_ids = [uuid.uuid4() for _ in range(5)]
+
+    def make_campaigns(self, count):
+        return [
+            CampaignModel(
+                campaign_id=uuid.uuid4(),
+                advertiser_id=self.random.choice(self.advertiser_ids),
+                impressions_limit=self.random.choice([0, 1, 10, 100, 1000]),
+                cost_per_impression=self.random.choice([0.0, 0.5, 1.0, self.random.uniform(0, 5)]),
+                cost_per_click=self.random.choice([0.0, 1.0, self.random.uniform(0, 10)]),
+                target_min_age=0,
+                target_max_age=1000,
+            )
+            for _ in range(count)
+        ]
+
+    def test_rank_matches_reference(self):
+        for _ in range(200):
+            # Равные composite_score разрешаются по campaign_id, эталон получает кампании в том же порядке
+            campaigns = sorted(self.make_campaigns(self.random.randint(0, 30)), key=lambda c: c.campaign_id)
+            ml_score_map = {advertiser_id: self.random.randint(0, 100) / 100
+                            for advertiser_id in self.random.sample(self.advertiser_ids, 3)}
+            total_views = [self.random.randint(0, 2500) for _ in campaigns]
+            is_violated = [self.random.random() < 0.3 for _ in campaigns]
+
+            matrix = CampaignMatrix([CampaignRecord.from_row(campaign)[0] for campaign in campaigns])
+            ranked = matrix.rank(
+                ml_scores=matrix.ml_scores(ml_score_map),
+                total_views=np.asarray(total_views, dtype=np.float64),
+                is_violated=np.asarray(is_violated, dtype=bool),
+                top_k=len(campaigns)
+            )
+            expected = reference_ranking(campaigns, ml_score_map, total_views, is_violated)
+            self.assertEqual([campaigns[i] for i in ranked], expected)
+
+    def test_rank_top_one(self):
+        campaigns = self.make_campaigns(50)
+        matrix = CampaignMatrix([CampaignRecord.from_row(campaign)[0] for campaign in campaigns])
+        ml_scores = matrix.ml_scores({self.advertiser_ids[0]: 0.5})
+        total_views = np.zeros(len(campaigns))
+        is_violated = np.zeros(len(campaigns), dtype=bool)
+
+        best = matrix.rank(ml_scores, total_views, is_violated)
+        ranked = matrix.rank(ml_scores, total_views, is_violated, top_k=len(campaigns))
+        self.assertEqual(list(best), list(ranked[:1]))
+
+    def test_rank_empty(self):
+        matrix = CampaignMatrix([])
+        self.assertEqual(len(matrix.rank(np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool))), 0)
+
+
+class TestTargetingIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.random = random.Random(7)
+        self.locations = ["Moscow", "Paris", "London"]
+        self.location_ids = {location: i for i, location in enumerate(self.locations, 1)}
+
+    def make_targeting(self):
+        targeting = {}
+        if self.random.random() < 0.5:
+            targeting["gender"] = self.random.choice(["MALE", "FEMALE", "ALL"])
+        if self.random.random() < 0.5:
+            targeting["location"] = self.random.choice(self.locations + [""])
+        if self.random.random() < 0.3:
+            targeting["min_age"] = self.random.randint(0, 50)
+            targeting["max_age"] = self.random.randint(30, 100)
+        return self.random.choice([None, targeting, targeting])
+
+    def test_matches_is_targeting_violated(self):
+        campaigns = [CampaignModel(targeting=self.make_targeting()) for _ in range(300)]
+        parsed = [parse_targeting(campaign.targeting) for campaign in campaigns]
+        index = TargetingIndex([compile_targeting(p, self.location_ids.get(p[3])) for p in parsed])
+
+        for _ in range(100):
+            client = ClientModel(
+                age=self.random.randint(0, 100),
+                gender=self.random.choice([Gender.MALE, Gender.FEMALE]),
+                location=self.random.choice(self.locations + ["Berlin"]),
+            )
+            expected = [is_targeting_violated(client, campaign) for campaign in campaigns]
+            violated = index.is_violated(gender_code(client.gender), client.age, self.location_ids.get(client.location))
+            self.assertEqual(violated.tolist(), expected)
+
+
+class TestSqlRankingEngine(unittest.TestCase):
+    def setUp(self) -> None:
+        reset_db()
+        self.random = random.Random(19)
+        self.locations = ["Moscow", "Paris", "London"]
+        self.advertiser_ids = [uuid.uuid4() for _ in range(4)]
+        self.clients = [
+            ClientModel(
+                client_id=uuid.uuid4(),
+                login="login",
+                age=self.random.randint(0, 100),
+                gender=self.random.choice([Gender.MALE, Gender.FEMALE]),
+                location=self.random.choice(self.locations + ["Berlin"]),
+            )
+            for _ in range(20)
+        ]
+        asyncio.run(self.populate())
+
+    def make_targeting(self):
+        targeting = {}
+        if self.random.random() < 0.5:
+            targeting["gender"] = self.random.choice(["MALE", "FEMALE", "ALL"])
+        if self.random.random() < 0.5:
+            targeting["location"] = self.random.choice(self.locations)
+        if self.random.random() < 0.3:
+            targeting["min_age"] = self.random.randint(0, 50)
+            targeting["max_age"] = self.random.randint(30, 100)
+        return targeting or None
+
+    async def populate(self):
+        async with SessionLocal() as session:
+            session.add_all(AdvertiserModel(advertiser_id=advertiser_id, name="advertiser")
+                            for advertiser_id in self.advertiser_ids)
+            session.add_all(ClientModel(client_id=client.client_id, login=client.login, age=client.age,
+                                        gender=client.gender, location=client.location) for client in self.clients)
+            await session.flush()
+
+            for client in self.clients:
+                for advertiser_id in self.random.sample(self.advertiser_ids, 2):
+                    session.add(MLScoreModel(client_id=client.client_id, advertiser_id=advertiser_id,
+                                             score=self.random.randint(0, 100)))
+
+            for _ in range(60):
+                targeting = self.make_targeting()
+                campaign = CampaignModel(
+                    advertiser_id=self.random.choice(self.advertiser_ids),
+                    impressions_limit=self.random.choice([0, 1, 3, 7, 10, 100]),
+                    clicks_limit=0,
+                    cost_per_impression=self.random.choice([0.0, 0.5, self.random.uniform(0, 5)]),
+                    cost_per_click=self.random.choice([0.0, 1.0, self.random.uniform(0, 10)]),
+                    ad_title="title",
+                    ad_text="text",
+                    start_date=self.random.randint(0, 3),
+                    end_date=self.random.randint(3, 6),
+                    targeting=targeting,
+                    **await compiled_targeting_columns(session, targeting),
+                )
+                session.add(campaign)
+                await session.flush()
+                for day in range(self.random.randint(0, 3)):
+                    session.add(DailyStatsModel(campaign_id=campaign.campaign_id, day=day,
+                                                impressions_count=self.random.randint(0, 12), clicks_count=0,
+                                                spent_impressions=0.0, spent_clicks=0.0))
+            await session.commit()
+
+    async def rank(self, client, day):
+        async with SessionLocal() as session:
+            ranked = (await session.scalars(
+                text("SELECT campaign_id FROM rank_campaigns(:day, :client_id, :gender, :age, :location)"),
+                {"day": day, "client_id": client.client_id, "gender": gender_code(client.gender),
+                 "age": client.age, "location": client.location}
+            )).all()
+
+            campaigns = (await session.scalars(
+                select(CampaignModel).where(CampaignModel.start_date <= day, CampaignModel.end_date >= day)
+                .order_by(CampaignModel.campaign_id)
+            )).all()
+            totals = dict((await session.execute(
+                select(DailyStatsModel.campaign_id, func.sum(DailyStatsModel.impressions_count))
+                .group_by(DailyStatsModel.campaign_id)
+            )).all())
+            ml_score_map = dict((await session.execute(
+                select(MLScoreModel.advertiser_id, MLScoreModel.score).where(MLScoreModel.client_id == client.client_id)
+            )).all())
+
+        expected = reference_ranking(
+            campaigns,
+            {advertiser_id: score / 100 for advertiser_id, score in ml_score_map.items()},
+            [totals.get(campaign.campaign_id, 0) for campaign in campaigns],
+            [is_targeting_violated(client, campaign) for campaign in campaigns],
+        )
+        return ranked, [campaign.campaign_id for campaign in expected]
+
+    def test_matches_reference_ranking(self):
+        for client in self.clients:
+            for day in range(7):
+                ranked, expected = asyncio.run(self.rank(client, day))
+                self.assertEqual(ranked, expected)
+
+    def test_tied_scores_pick_the_same_campaign(self):
+        async def add_tied_campaigns():
+            async with SessionLocal() as session:
+                campaigns = [
+                    CampaignModel(advertiser_id=self.advertiser_ids[0], impressions_limit=0, clicks_limit=0,
+                                  cost_per_impression=100.0, cost_per_click=0.0, ad_title="title", ad_text="text",
+                                  start_date=10, end_date=10)
+                    for _ in range(5)
+                ]
+                session.add_all(campaigns)
+                await session.commit()
+                return [campaign.campaign_id for campaign in campaigns]
+
+        tied = asyncio.run(add_tied_campaigns())
+        client = self.clients[0]
+        ranked, _ = asyncio.run(self.rank(client, 10))
+        self.assertEqual(ranked, sorted(tied))
+
+        async def load_records():
+            async with SessionLocal() as session:
+                return (await load_active_campaigns(session, 10))[0]
+
+        # Порядок загрузки снапшота не влияет на победителя
+        records = list(asyncio.run(load_records()).values())
+        for order in (records, records[::-1]):
+            matrix = CampaignMatrix(order)
+            best = select_best_campaign({}, client, matrix, [0] * len(matrix))
+            self.assertEqual(best.campaign_id, ranked[0])
+
+    def test_get_ads_with_sql_engine(self):
+        client = self.clients[0]
+        ranked, _ = asyncio.run(self.rank(client, 0))
+        redis.Redis.from_url(settings.REDIS_URL).set("current_date", 0)
+
+        with patch.object(Settings, "AD_DECISION_ENGINE", "sql"):
+            response = TestClient(app).get("/ads", params={"client_id": str(client.client_id)})
+        if ranked:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["ad_id"], str(ranked[0]))
+        else:
+            self.assertEqual(response.status_code, 404)
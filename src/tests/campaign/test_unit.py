@@ -1,10 +1,14 @@
+import asyncio
 import unittest
 import uuid
+from unittest.mock import AsyncMock, patch
 
 import httpx
 from fastapi.testclient import TestClient
+from sqlalchemy import select
 from src.main import app
-from src.config import reset_db
+from src.campaign.models import CampaignModel, LocationModel
+from src.config import reset_db, SessionLocal
 
 
 class TestCampaignEndpoints(unittest.TestCase):
@@ -77,6 +81,58 @@ class TestCampaignEndpoints(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["ad_title"], "Updated Ad")
 
+    def test_targeting_is_compiled(self):
+        response = self.client.put(
+            f"/advertisers/{self.advertiser_id}/campaigns/{self.campaign_id}",
+            json={"targeting": {"gender": "male", "location": "Moscow"}}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any(key.startswith("target_") for key in response.json()))
+
+        response = self.client.post(
+            f"/advertisers/{self.advertiser_id}/campaigns",
+            params={"isGenerate": False},
+            json={
+                "ad_title": "Test Ad",
+                "ad_text": "Test text",
+                "impressions_limit": 1000,
+                "clicks_limit": 100,
+                "cost_per_impression": 0.5,
+                "cost_per_click": 1.0,
+                "start_date": 500,
+                "end_date": 999,
+                "targeting": {"gender": "all", "location": "Moscow"}
+            }
+        )
+        self.assertEqual(response.status_code, 201)
+        campaign_id = uuid.UUID(response.json()["campaign_id"])
+
+        async def load():
+            async with SessionLocal() as session:
+                return (await session.get(CampaignModel, self.campaign_id),
+                        await session.get(CampaignModel, campaign_id),
+                        (await session.scalars(select(LocationModel))).all())
+
+        updated, created, locations = asyncio.run(load())
+        self.assertEqual([location.name for location in locations], ["Moscow"])
+        self.assertEqual(updated.target_gender, 1)
+        self.assertIsNone(created.target_gender)
+        self.assertEqual(updated.target_location_id, locations[0].location_id)
+        self.assertEqual(created.target_location_id, locations[0].location_id)
+        self.assertEqual((created.target_min_age, created.target_max_age), (0, 1000))
+
+    def test_targeting_is_compiled_after_text_validation(self):
+        # Справочник локаций не трогается, пока идёт запрос к LLM и если текст отклонён
+        rejection = httpx.Response(200, json={"status": "reject", "reason": "spam"})
+        with patch("httpx.AsyncClient.post", AsyncMock(return_value=rejection)), \
+                patch("src.campaign.router.compiled_targeting_columns", AsyncMock()) as compile_targeting:
+            response = self.client.put(
+                f"/advertisers/{self.advertiser_id}/campaigns/{self.campaign_id}",
+                json={"ad_text": "Spam", "targeting": {"location": "Paris"}}
+            )
+        self.assertEqual(response.status_code, 400)
+        compile_targeting.assert_not_called()
+
     def test_delete_advertiser_campaign(self):
         response = self.client.delete(f"/advertisers/{self.advertiser_id}/campaigns/{self.campaign_id}")
         self.assertEqual(response.status_code, 204)
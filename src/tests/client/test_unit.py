@@ -1,8 +1,14 @@
+import asyncio
 import unittest
+import uuid
+from contextlib import suppress
+
+import redis.asyncio as redis
 from fastapi.testclient import TestClient
 
 from src.main import app
-from src.config import reset_db
+from src.config import reset_db, settings, Gender, SessionLocal
+from src.client.cache import CLIENT_PROFILES_KEY, ClientProfileCache
 from fastapi import status
 
 
@@ -119,3 +125,77 @@ class TestClientEndpoints(unittest.TestCase):
         response = self.client.delete(f"/clients/{self.valid_client_id}")
         self.assertEqual(response.status_code, 405)
 
+
+
+class TestClientProfileCache(unittest.TestCase):
+    def setUp(self) -> None:
+        reset_db()
+        self.client = TestClient(app)
+        self.client_id = uuid.UUID("333e4567-e89b-12d3-a456-426614174000")
+        self.client.post("/clients/bulk", json=[{
+            "client_id": str(self.client_id),
+            "login": "user1",
+            "age": 25,
+            "location": "Moscow",
+            "gender": "Male"
+        }])
+
+    def test_workers_evict_profiles_updated_elsewhere(self):
+        async def scenario():
+            cache, other_worker = ClientProfileCache(max_size=10), ClientProfileCache(max_size=10)
+            r = redis.Redis.from_url(settings.REDIS_URL)
+            listener = asyncio.create_task(cache.listen())
+            try:
+                while not cache.synced:
+                    await asyncio.sleep(0.01)
+                async with SessionLocal() as session:
+                    profile = await cache.get(r, session, self.client_id)
+                    self.assertEqual((profile.age, profile.location), (25, "Moscow"))
+                    self.assertIsNone(await cache.get(r, session, uuid.uuid4()))
+
+                    await other_worker.store(r, [profile._replace(location="Paris")])
+                    for _ in range(100):
+                        if (await cache.get(r, session, self.client_id)).location == "Paris":
+                            break
+                        await asyncio.sleep(0.01)
+                    self.assertEqual((await cache.get(r, session, self.client_id)).location, "Paris")
+            finally:
+                listener.cancel()
+                with suppress(asyncio.CancelledError):
+                    await listener
+                await r.aclose()
+
+        asyncio.run(scenario())
+
+    def test_lru_is_bounded(self):
+        client_ids = [uuid.uuid4() for _ in range(3)]
+        self.client.post("/clients/bulk", json=[{
+            "client_id": str(client_id),
+            "login": "login",
+            "age": 30,
+            "location": "Moscow",
+            "gender": "Male"
+        } for client_id in client_ids])
+
+        async def scenario():
+            cache = ClientProfileCache(max_size=2)
+            r = redis.Redis.from_url(settings.REDIS_URL)
+            listener = asyncio.create_task(cache.listen())
+            try:
+                while not cache.synced:
+                    await asyncio.sleep(0.01)
+                async with SessionLocal() as session:
+                    for client_id in client_ids:
+                        await cache.get(r, session, client_id)
+                    # Хэш меняется в обход /clients/bulk: новое значение видно только вытесненному из LRU профилю
+                    await r.hset(CLIENT_PROFILES_KEY, mapping={
+                        str(client_id): f"30|{Gender.MALE.value}|Paris" for client_id in client_ids
+                    })
+                    return [(await cache.get(r, session, client_id)).location for client_id in reversed(client_ids)]
+            finally:
+                listener.cancel()
+                with suppress(asyncio.CancelledError):
+                    await listener
+                await r.aclose()
+
+        self.assertEqual(asyncio.run(scenario()), ["Moscow", "Moscow", "Paris"])
@@ -0,0 +1,5 @@
+import os
+
+# TestClient без контекстного менеджера поднимает свой event loop на каждый запрос,
+# а соединения asyncpg привязаны к loop, поэтому в тестах пул отключаем
+os.environ.setdefault("POSTGRES_POOL_SIZE", "0")
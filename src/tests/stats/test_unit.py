@@ -1,9 +1,23 @@
+import asyncio
 import unittest
 import uuid
+from unittest.mock import patch
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import redis.asyncio as aioredis
 
 from fastapi.testclient import TestClient
+from sqlalchemy import func, select, update
 from src.main import app
-from src.config import reset_db
+from src.config import reset_db, SessionLocal, Settings, settings
+from src.ad.services import update_campaign_stats, Action
+from src.campaign.models import CampaignModel
+from src.stats import rollup
+from src.stats.cache import publish_stats_changes
+from src.stats.models import AdvertiserDailyStatsModel, DailyStatsModel
+from src.stats.services import advertiser_daily_totals, compact_daily_stats, rebuild_advertiser_daily_stats, \
+    verify_advertiser_daily_stats
 
 
 class TestStatsEndpoints(unittest.TestCase):
@@ -185,3 +199,297 @@ class TestStatsEndpoints(unittest.TestCase):
             f'/stats/advertisers/{uuid.UUID("00000000-0000-0000-0000-000000000000")}/campaigns/daily')
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json()["detail"], "Advertiser campaigns not found")
+
+
+class StatsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        reset_db()
+        self.client = TestClient(app)
+        self.advertiser_id = uuid.UUID("133e4567-e89b-12d3-a456-426614174000")
+        self.client.post("/advertisers/bulk", json=[
+            {"advertiser_id": str(self.advertiser_id), "name": "advertiser12"}])
+        response = self.client.post(
+            f"/advertisers/{self.advertiser_id}/campaigns",
+            params={"isGenerate": False},
+            json={
+                "ad_title": "Test Ad",
+                "ad_text": "Test text",
+                "impressions_limit": 1000,
+                "clicks_limit": 100,
+                "cost_per_impression": 0.5,
+                "cost_per_click": 1.0,
+                "start_date": 0,
+                "end_date": 999999,
+                "targeting": {}
+            }
+        )
+        self.campaign = CampaignModel(campaign_id=uuid.UUID(response.json()["campaign_id"]))
+
+    def record(self, day, views, clicks):
+        async def record(action):
+            r = aioredis.Redis.from_url(settings.REDIS_URL)
+            async with SessionLocal() as session:
+                await update_campaign_stats(action, day, session, self.campaign, 0.5, 1.0)
+                await publish_stats_changes(r, session)
+            await r.aclose()
+
+        async def record_all():
+            await asyncio.gather(*(record(Action.VIEW) for _ in range(views)),
+                                 *(record(Action.CLICK) for _ in range(clicks)))
+
+        asyncio.run(record_all())
+
+    def count_rows(self, model=DailyStatsModel):
+        async def count_rows():
+            async with SessionLocal() as session:
+                return await session.scalar(select(func.count()).select_from(model))
+
+        return asyncio.run(count_rows())
+
+
+class TestShardedStats(StatsTestCase):
+    def test_shards_are_merged_on_read_and_compacted(self):
+        with patch.object(Settings, "STATS_SHARDS", 4):
+            self.record(0, 40, 10)
+            self.record(1, 20, 0)
+        self.assertGreater(self.count_rows(), 2)
+        self.assertGreater(self.count_rows(AdvertiserDailyStatsModel), 2)
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily")
+        self.assertEqual([(day["date"], day["impressions_count"]) for day in response.json()], [(0, 40), (1, 20)])
+
+        response = self.client.get(f"/stats/campaigns/{self.campaign.campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 60)
+        self.assertEqual(response.json()["clicks_count"], 10)
+        self.assertEqual(response.json()["spent_total"], 40.0)
+
+        response = self.client.get(f"/stats/campaigns/{self.campaign.campaign_id}/daily")
+        self.assertEqual([(day["date"], day["impressions_count"]) for day in response.json()], [(0, 40), (1, 20)])
+
+        async def compact():
+            async with SessionLocal() as session:
+                await compact_daily_stats(session, before_day=2)
+
+        asyncio.run(compact())
+        self.assertEqual(self.count_rows(), 2)
+        self.assertEqual(self.count_rows(AdvertiserDailyStatsModel), 2)
+        response = self.client.get(f"/stats/campaigns/{self.campaign.campaign_id}/daily")
+        self.assertEqual([(day["date"], day["impressions_count"], day["clicks_count"]) for day in response.json()],
+                         [(0, 40, 10), (1, 20, 0)])
+
+
+class TestStatsAggregation(StatsTestCase):
+    def test_empty_stats(self):
+        response = self.client.get(f"/stats/campaigns/{self.campaign.campaign_id}")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "Campaign stats not found")
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["impressions_count"], 0)
+        self.assertEqual(response.json()["conversion"], 0)
+
+        response = self.client.get(f"/stats/advertisers/{uuid.uuid4()}/campaigns/")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "Advertiser not found")
+
+    def test_advertiser_totals_span_campaigns_and_days(self):
+        first = self.campaign
+        response = self.client.post(
+            f"/advertisers/{self.advertiser_id}/campaigns",
+            params={"isGenerate": False},
+            json={
+                "ad_title": "Test Ad",
+                "ad_text": "Test text",
+                "impressions_limit": 1000,
+                "clicks_limit": 100,
+                "cost_per_impression": 0.5,
+                "cost_per_click": 1.0,
+                "start_date": 0,
+                "end_date": 999999,
+                "targeting": {}
+            }
+        )
+        self.campaign = CampaignModel(campaign_id=uuid.UUID(response.json()["campaign_id"]))
+        self.record(0, 10, 5)
+        self.campaign = first
+        self.record(0, 20, 0)
+        self.record(3, 10, 5)
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/")
+        self.assertEqual(response.json(), {
+            "impressions_count": 40,
+            "clicks_count": 10,
+            "conversion": 25.0,
+            "spent_impressions": 20.0,
+            "spent_clicks": 10.0,
+            "spent_total": 30.0
+        })
+
+        response = self.client.get(f"/stats/campaigns/{first.campaign_id}")
+        self.assertEqual(response.json()["impressions_count"], 30)
+        self.assertEqual(response.json()["conversion"], 5 / 30 * 100)
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily")
+        self.assertEqual([(day["date"], day["impressions_count"], day["clicks_count"], day["conversion"])
+                          for day in response.json()], [(0, 30, 5, 5 / 30 * 100), (3, 10, 5, 50.0)])
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily",
+                                   params={"from_day": 1, "to_day": 5})
+        self.assertEqual([day["date"] for day in response.json()], [3])
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily",
+                                   params={"to_day": 2})
+        self.assertEqual([day["date"] for day in response.json()], [0])
+
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily",
+                                   params={"from_day": 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+    def test_advertiser_rollup_verify_and_rebuild(self):
+        self.record(0, 10, 2)
+        self.record(1, 5, 0)
+
+        async def check():
+            async with SessionLocal() as session:
+                return await verify_advertiser_daily_stats(session)
+
+        async def corrupt():
+            async with SessionLocal() as session:
+                await session.execute(update(AdvertiserDailyStatsModel).where(AdvertiserDailyStatsModel.day == 1)
+                                      .values(impressions_count=999))
+                await session.commit()
+
+        async def rebuild():
+            async with SessionLocal() as session:
+                await rebuild_advertiser_daily_stats(session)
+
+        self.assertEqual(asyncio.run(check()), [])
+        asyncio.run(corrupt())
+        drift = asyncio.run(check())
+        self.assertEqual([(day, stored[0]) for _, day, _, stored in drift], [(1, 999)])
+
+        asyncio.run(rebuild())
+        self.assertEqual(asyncio.run(check()), [])
+        response = self.client.get(f"/stats/advertisers/{self.advertiser_id}/campaigns/daily")
+        self.assertEqual([(day["date"], day["impressions_count"]) for day in response.json()], [(0, 10), (1, 5)])
+
+
+class TestStatsCache(StatsTestCase):
+    def test_etag_and_not_modified(self):
+        self.record(0, 10, 1)
+        url = f"/stats/campaigns/{self.campaign.campaign_id}"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertEqual(response.json()["impressions_count"], 10)
+
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.json()["impressions_count"], 10)
+
+    def test_if_none_match_lists_weak_tags_and_wildcard(self):
+        self.record(0, 10, 1)
+        url = f"/stats/campaigns/{self.campaign.campaign_id}"
+        etag = self.client.get(url).headers["ETag"]
+
+        for header in (f'"other", {etag}', f'W/{etag}', f' "a,b" , W/{etag}', "*"):
+            response = self.client.get(url, headers={"If-None-Match": header})
+            self.assertEqual(response.status_code, 304, header)
+
+        response = self.client.get(url, headers={"If-None-Match": '"other", W/"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+        # "*" не совпадает с отсутствующим ресурсом
+        response = self.client.get(f"/stats/campaigns/{uuid.uuid4()}", headers={"If-None-Match": "*"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_stats_invalidate_cached_responses(self):
+        self.record(0, 10, 1)
+        campaign_url = f"/stats/campaigns/{self.campaign.campaign_id}/daily"
+        advertiser_url = f"/stats/advertisers/{self.advertiser_id}/campaigns/"
+        campaign_etag = self.client.get(campaign_url).headers["ETag"]
+        advertiser_etag = self.client.get(advertiser_url).headers["ETag"]
+
+        self.record(1, 5, 0)
+        response = self.client.get(campaign_url, headers={"If-None-Match": campaign_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], campaign_etag)
+        self.assertEqual([day["impressions_count"] for day in response.json()], [10, 5])
+
+        response = self.client.get(advertiser_url, headers={"If-None-Match": advertiser_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["impressions_count"], 15)
+
+    def test_rollup_rebuild_invalidates_etags(self):
+        self.record(0, 10, 1)
+        url = f"/stats/advertisers/{self.advertiser_id}/campaigns/"
+        etag = self.client.get(url).headers["ETag"]
+
+        self.assertEqual(asyncio.run(rollup.run("rebuild")), 0)
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.json()["impressions_count"], 10)
+
+    def test_cache_key_ignores_unknown_and_reordered_params(self):
+        self.record(0, 10, 1)
+        url = f"/stats/advertisers/{self.advertiser_id}/campaigns/daily"
+        with patch("src.stats.router.advertiser_daily_totals", wraps=advertiser_daily_totals) as compute:
+            for query in ("from_day=0&to_day=5", "to_day=5&from_day=0", "from_day=0&to_day=5&junk=1",
+                          "junk=2&to_day=5&from_day=0"):
+                self.assertEqual(self.client.get(f"{url}?{query}").status_code, 200)
+        # Все четыре запроса читают одни параметры, поэтому агрегат считается один раз
+        compute.assert_called_once()
+
+    def test_errors_are_not_cached(self):
+        url = f"/stats/campaigns/{self.campaign.campaign_id}"
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.record(0, 10, 1)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TestStatsExport(StatsTestCase):
+    def test_arrow_export_merges_shards_in_batches(self):
+        with patch.object(Settings, "STATS_SHARDS", 4):
+            for day in range(5):
+                self.record(day, day + 1, 1)
+
+        with patch.object(Settings, "STATS_EXPORT_BATCH_SIZE", 2):
+            response = self.client.get("/stats/export", params={"from_day": 1, "to_day": 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/vnd.apache.arrow.stream")
+
+        reader = pa.ipc.open_stream(response.content)
+        batches = list(reader)
+        self.assertEqual([batch.num_rows for batch in batches], [2, 1])
+        table = pa.Table.from_batches(batches, schema=reader.schema)
+        self.assertEqual(table.column("day").to_pylist(), [1, 2, 3])
+        self.assertEqual(table.column("impressions_count").to_pylist(), [2, 3, 4])
+        self.assertEqual(table.column("spent_clicks").to_pylist(), [1.0, 1.0, 1.0])
+        self.assertEqual(set(table.column("advertiser_id").to_pylist()), {str(self.advertiser_id)})
+
+    def test_parquet_export_filters_by_advertiser(self):
+        self.record(0, 10, 2)
+
+        response = self.client.get("/stats/export", params={"format": "parquet",
+                                                            "advertiser_id": str(self.advertiser_id)})
+        table = pq.read_table(pa.BufferReader(response.content))
+        self.assertEqual(table.to_pylist(), [{
+            "campaign_id": str(self.campaign.campaign_id),
+            "advertiser_id": str(self.advertiser_id),
+            "day": 0,
+            "impressions_count": 10,
+            "clicks_count": 2,
+            "spent_impressions": 5.0,
+            "spent_clicks": 2.0,
+        }])
+
+        response = self.client.get("/stats/export", params={"format": "parquet", "advertiser_id": str(uuid.uuid4())})
+        self.assertEqual(pq.read_table(pa.BufferReader(response.content)).num_rows, 0)
+
+        response = self.client.get("/stats/export", params={"format": "csv"})
+        self.assertEqual(response.status_code, 422)
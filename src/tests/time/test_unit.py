@@ -1,6 +1,12 @@
+import asyncio
 import unittest
+from contextlib import suppress
+
+import redis.asyncio as redis
 from fastapi.testclient import TestClient
 from src.main import app
+from src.config import settings
+from src.time.state import WorkerState
 
 client = TestClient(app)
 
@@ -26,4 +32,48 @@ class TestTimeEndpoints(unittest.TestCase):
 
         for case in test_cases:
             response = client.post("/time/advance", json=case)
-            self.assertEqual(response.status_code, 422)
\ No newline at end of file
+            self.assertEqual(response.status_code, 422)
+
+class TestWorkerState(unittest.TestCase):
+    def test_values_follow_published_updates(self):
+        async def scenario():
+            state = WorkerState()
+            r = redis.Redis.from_url(settings.REDIS_URL)
+            listener = asyncio.create_task(state.listen())
+            try:
+                await r.setnx("current_date", 0)
+                today = int(await r.get("current_date"))
+                self.assertEqual([int(value) for value in await state.get(r, "current_date")], [today])
+
+                while not state.synced:
+                    await asyncio.sleep(0.01)
+                await r.set("current_date", today + 1)
+                await WorkerState().publish(r, "current_date", today + 1)
+                for _ in range(100):
+                    if await state.get(r, "current_date") == [today + 1]:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(await state.get(r, "current_date"), [today + 1])
+
+                # Запоздавшее сообщение не откатывает значение назад
+                await WorkerState().publish(r, "current_date", today)
+                await asyncio.sleep(0.1)
+                self.assertEqual(await state.get(r, "current_date"), [today + 1])
+            finally:
+                listener.cancel()
+                with suppress(asyncio.CancelledError):
+                    await listener
+                await r.aclose()
+
+        asyncio.run(scenario())
+
+
+class TestRedisPool(unittest.TestCase):
+    def test_requests_share_lifespan_pool(self):
+        with TestClient(app) as lifespan_client:
+            pool = app.state.redis_pool
+            for day in range(1, 6):
+                response = lifespan_client.post("/time/advance", json={"current_date": day})
+                self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(pool._available_connections) + len(pool._in_use_connections), 2)
+        self.assertIsNone(app.state.redis_pool)
@@ -3,6 +3,8 @@ from fastapi.params import Depends
 import redis.asyncio as redis
 from src.time.schemas import *
 from src.config import get_redis
+from src.ad.utils import clear_views_before, mark_day_start
+from src.time.state import worker_state
 from fastapi import HTTPException
 router = APIRouter()
 
@@ -15,5 +17,9 @@ async def SetTime(current_date: TimeSchema, redis_db: redis.Redis = Depends(get_
     now_date = await redis_db.get("current_date")
     if int(now_date) > current_date.current_date:
         raise HTTPException(status_code=400, detail="Cannot set date to past")
+    await mark_day_start(redis_db, current_date.current_date)
     await redis_db.set('current_date', current_date.current_date)
+    await worker_state.publish(redis_db, "current_date", current_date.current_date)
+    # Множества показов прошедших дней больше не нужны
+    await clear_views_before(redis_db, current_date.current_date)
     return {"current_date": current_date.current_date}
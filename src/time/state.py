@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Канал, в который SetTime и CRUD кампаний публикуют новые значения "name=value"
+STATE_CHANNEL = "worker_state"
+STATE_KEYS = ("current_date", "campaigns_version")
+
+
+# ========================
+# WORKER STATE
+# ========================
+
+class WorkerState:
+    """
+    Копия current_date и campaigns_version в памяти воркера.
+
+    Значения приходят через Redis pub/sub. Пока подписка не установлена
+    или после обрыва до повторной синхронизации значения читаются из Redis.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, int] = {}
+        self._synced = False
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    async def get(self, r: redis.Redis, *names: str) -> List[Optional[int]]:
+        if self._synced:
+            return [self._values.get(name) for name in names]
+        return await r.mget(*names)
+
+    def update(self, name: str, value: int) -> None:
+        # Оба значения только растут, поэтому запоздавшее сообщение не откатывает состояние
+        current = self._values.get(name)
+        if current is None or value > current:
+            self._values[name] = value
+
+    async def publish(self, r: redis.Redis, name: str, value: int) -> None:
+        self.update(name, value)
+        await r.publish(STATE_CHANNEL, f"{name}={value}")
+
+    async def listen(self) -> None:
+        r = redis.Redis.from_url(settings.REDIS_URL)
+        try:
+            while True:
+                try:
+                    async with r.pubsub() as pubsub:
+                        await pubsub.subscribe(STATE_CHANNEL)
+                        # Подписка раньше чтения: обновления между ними не теряются
+                        await self._resync(r)
+                        async for message in pubsub.listen():
+                            if message["type"] == "message":
+                                name, value = message["data"].decode().split("=")
+                                self.update(name, int(value))
+                except redis.RedisError:
+                    logger.exception("Worker state subscription lost")
+                finally:
+                    self._synced = False
+                await asyncio.sleep(1)
+        finally:
+            await r.aclose()
+
+    async def _resync(self, r: redis.Redis) -> None:
+        for name, value in zip(STATE_KEYS, await r.mget(*STATE_KEYS)):
+            if value is not None:
+                self.update(name, int(value))
+        self._synced = True
+
+
+worker_state = WorkerState()